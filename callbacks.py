@@ -191,3 +191,59 @@ class SaveLastTrainedEpochCallback(callbacks.Callback):
                 "batch_size": self.batch_size,
                 "weights": self.weights_path
             }, fp)
+
+
+class FullFrameValidation(Callback):
+    """
+    Validates on full frames while the model trains on crops.
+    On epoch end weights of the trained model are copied to the model of full size, which is evaluated
+    and its results are stored in logs as val_* (so checkpoints and early stopping can monitor them).
+    Must be before callbacks that read validation logs.
+    """
+
+    def __init__(self, train_model, eval_model, generator, steps):
+        """
+        :param keras.models.Model train_model: model trained on crops (single GPU template)
+        :param keras.models.Model eval_model: compiled model of full frame size
+        :param generator: batches of full frames
+        :param int steps: validation batches
+        """
+        self.train_model = train_model
+        self.eval_model = eval_model
+        self.generator = generator
+        self.steps = steps
+        super(FullFrameValidation, self).__init__()
+
+    def on_epoch_end(self, epoch, logs=None):
+        if logs is None:
+            logs = {}
+
+        self.eval_model.set_weights(self.train_model.get_weights())
+        values = self.eval_model.evaluate_generator(self.generator, self.steps)
+
+        for name, value in zip(self.eval_model.metrics_names, np.atleast_1d(values)):
+            logs['val_' + name] = value
+
+
+class SampleLossFeedback(Callback):
+    """
+    Feeds training loss of every batch back to the importance sampler of the generator,
+    which assigns it to samples of the batch (oldest batch yielded by `flow` not recorded yet).
+    Coverage of the dataset is reported on epoch end and stored in logs.
+    """
+
+    def __init__(self, sampler):
+        """
+        :param ImportanceSampler sampler: sampler of training `flow`
+        """
+        self.sampler = sampler
+        super(SampleLossFeedback, self).__init__()
+
+    def on_batch_end(self, batch, logs=None):
+        if logs is not None and 'loss' in logs:
+            self.sampler.record(float(logs['loss']))
+
+    def on_epoch_end(self, epoch, logs=None):
+        print("-- " + str(self.sampler))
+        if logs is not None:
+            logs['sample_coverage'] = self.sampler.coverage
@@ -0,0 +1,160 @@
+import random
+from collections import namedtuple
+
+import cv2
+import numpy as np
+
+# parameters of one sample, the same for all its frames, labels and optical flow
+AugmentParams = namedtuple('AugmentParams', ['flip', 'gamma', 'angle', 'scale'])
+
+# random crop of one sample, frames are loaded at source_size and cropped to size at (y, x)
+CropWindow = namedtuple('CropWindow', ['source_size', 'size', 'y', 'x'])
+
+
+class Augmenter:
+    """
+    Photometric (brightness) and geometric (flip, rotation, zoom) augmentation.
+
+    Parameters are sampled once per sample and applied to everything in it: all frames are stacked and
+    transformed by one warp call, labels use the same transform with nearest interpolation and optical flow
+    gets its vectors transformed as well.
+    """
+
+    def __init__(self, flip_enabled=False, brightness=0.1, rotation=0., zoom=0.):
+        """
+        :param bool flip_enabled: random horizontal flip
+        :param float brightness: sigma of gamma correction
+        :param float rotation: sigma of rotation (degrees), 0 = off
+        :param float zoom: sigma of zoom (around 1.0), 0 = off
+        """
+        self.flip_enabled = flip_enabled
+        self.brightness = brightness
+        self.rotation = rotation
+        self.zoom = zoom
+        self._values = np.arange(256, dtype=np.float64) / 255.0
+
+    def sample(self, flip=None):
+        """
+        :param bool flip: forces flip decision (otherwise random if flip is enabled)
+        :rtype: AugmentParams
+        """
+        if flip is None:
+            flip = self.flip_enabled and random.randint(0, 1)
+
+        gamma = 1.0
+        if self.brightness:
+            gamma = 1.0 + abs(random.gauss(mu=0.0, sigma=self.brightness))
+            if random.randint(0, 1):
+                gamma = 1.0 / gamma
+
+        angle = random.gauss(mu=0.0, sigma=self.rotation) if self.rotation else 0.0
+        scale = random.gauss(mu=1.0, sigma=self.zoom) if self.zoom else 1.0
+
+        return AugmentParams(bool(flip), gamma, angle, scale)
+
+    @staticmethod
+    def crop_window(source_size, size, align=1):
+        """
+        :param tuple source_size: (height, width) of loaded frames
+        :param tuple size: (height, width) of the crop
+        :param int align: offsets are multiples of align (e.g. the coarsest label scale)
+        :rtype: CropWindow
+        """
+        if size[0] > source_size[0] or size[1] > source_size[1]:
+            raise Exception('Crop %s is larger than frame %s!' % (str(size), str(source_size)))
+
+        y = random.randint(0, (source_size[0] - size[0]) // align) * align
+        x = random.randint(0, (source_size[1] - size[1]) // align) * align
+        return CropWindow(tuple(source_size), tuple(size), y, x)
+
+    @staticmethod
+    def crop(arr, window, sub=1):
+        """
+        :param arr: image, label or flow of window.source_size // sub
+        :param CropWindow window:
+        :param int sub: scale of arr
+        :return: contiguous crop of size window.size // sub
+        """
+        y, x = window.y // sub, window.x // sub
+        height, width = window.size[0] // sub, window.size[1] // sub
+        return np.ascontiguousarray(arr[y:y + height, x:x + width])
+
+    @staticmethod
+    def is_affine(params):
+        return params.angle != 0.0 or params.scale != 1.0
+
+    def gamma_table(self, gamma):
+        return (np.power(self._values, gamma) * 255).astype(np.uint8)
+
+    @staticmethod
+    def matrix(params, size):
+        """
+        Affine transform (rotation and zoom around center, then flip) for image of given size
+        :param AugmentParams params:
+        :param tuple size: (height, width)
+        :return: 2x3 matrix
+        """
+        height, width = size
+        matrix = np.eye(3)
+        if Augmenter.is_affine(params):
+            matrix[:2] = cv2.getRotationMatrix2D((width / 2.0, height / 2.0), params.angle, params.scale)
+        if params.flip:
+            flip = np.array([[-1., 0., width - 1.], [0., 1., 0.], [0., 0., 1.]])
+            matrix = flip.dot(matrix)
+        return matrix[:2]
+
+    def _warp(self, arr, params, interpolation, border_value=0):
+        if not self.is_affine(params):
+            return cv2.flip(arr, 1) if params.flip else arr
+
+        height, width = arr.shape[:2]
+        warped = cv2.warpAffine(
+            arr, self.matrix(params, (height, width)), (width, height),
+            flags=interpolation,
+            borderMode=cv2.BORDER_CONSTANT,
+            borderValue=border_value
+        )
+        # opencv drops the channel axis of single channel images
+        return warped.reshape(arr.shape)
+
+    def frames(self, frames, params):
+        """
+        :param list frames: uint8 images of the sample (same size)
+        :param AugmentParams params:
+        :return list: augmented frames
+        """
+        if params.gamma != 1.0:
+            table = self.gamma_table(params.gamma)
+            frames = [cv2.LUT(frame, table) for frame in frames]
+
+        if len(frames) == 1:
+            return [self._warp(frames[0], params, cv2.INTER_LINEAR)]
+
+        # all frames are transformed by one warp
+        channels = [frame.shape[-1] for frame in frames]
+        stacked = self._warp(np.concatenate(frames, axis=-1), params, cv2.INTER_LINEAR)
+        return np.split(stacked, np.cumsum(channels)[:-1], axis=-1)
+
+    def labels(self, labels, params, void_index):
+        """
+        :param list labels: class indices (possibly of different scales)
+        :param AugmentParams params:
+        :param int void_index: class of pixels outside of the original label
+        :return list: augmented labels
+        """
+        return [self._warp(label, params, cv2.INTER_NEAREST, border_value=void_index) for label in labels]
+
+    def flow(self, flow, params):
+        """
+        Transforms optical flow computed between not augmented frames, so it matches the augmented ones
+        :param flow: (height, width, 2)
+        :param AugmentParams params:
+        :return: augmented flow
+        """
+        if not params.flip and not self.is_affine(params):
+            return flow
+
+        warped = self._warp(flow, params, cv2.INTER_LINEAR)
+        # vectors are transformed by the linear part of the transform
+        linear = self.matrix(params, flow.shape[:2])[:, :2]
+        return warped.dot(linear.T).astype(flow.dtype)
@@ -1,7 +1,7 @@
 import datetime
-import itertools
 import time
 from abc import ABCMeta, abstractmethod, abstractproperty
+from contextlib import contextmanager
 from math import ceil
 
 import cv2
@@ -9,7 +9,12 @@ import os
 import random
 import tensorflow as tf
 from keras.preprocessing.image import *
-import shutil
+
+from augmentation import Augmenter
+from label_encoding import LabelEncoder
+from preprocessing import Normalizer
+from sample_index import SampleIndex
+from sampler import ImportanceSampler, ShardSampler
 
 
 class threadsafe_iter:
@@ -26,7 +31,9 @@ class threadsafe_iter:
 
     def next(self):
         with self.lock:
-            return self.it.next()
+            return next(self.it)
+
+    __next__ = next
 
 
 def threadsafe_generator(f):
@@ -39,6 +46,20 @@ def threadsafe_generator(f):
     return g
 
 
+class LazySplits(dict):
+    """
+    Samples of dataset splits, a split is listed at its first access
+    """
+
+    def __init__(self, datagen):
+        super(LazySplits, self).__init__()
+        self._datagen = datagen
+
+    def __missing__(self, type):
+        self._datagen._load_split(type)
+        return dict.__getitem__(self, type)
+
+
 class BaseDataGenerator:
     __metaclass__ = ABCMeta
 
@@ -48,36 +69,67 @@ class BaseDataGenerator:
     def name(self):
         pass
 
-    def __init__(self, dataset_path, debug_samples=0, flip_enabled=False, rotation=5.0, zoom=0.1, brightness=0.1):
+    def __init__(self, dataset_path, debug_samples=0, flip_enabled=False, rotation=0., zoom=0., brightness=0.1, sparse_labels=False):
         self._debug_samples = debug_samples
         self.is_augment = debug_samples > 50 or debug_samples == 0
-        self._data = {'train': [], 'val': [], 'test': []}
+        self._data = LazySplits(self)
         self.dataset_path = dataset_path
+        self.index_dir = os.environ.get('SAMPLE_INDEX_DIR', os.path.join(dataset_path, '.index'))
         self.flip_enabled = flip_enabled
         self.zoom = zoom
         self.rotation = rotation
         self.brightness = brightness
+        self.sparse_labels = sparse_labels
+        self.augmenter = Augmenter(flip_enabled=flip_enabled, brightness=brightness, rotation=rotation, zoom=zoom)
+        self._stores = {}
+        self.image_cache = None
+        self.stager = None
+        self._clip_data = {}
+        self.crop_size = None
+        self.crop_scale = 1.0
+        self.rank = 0
+        self.world_size = 1
+        self.shard_seed = 2018
+        # samplers of splits drawing by training loss (see `use_importance_sampling`)
+        self._importance = {}
 
-        print("--- flip " + str(self.flip_enabled))
+        if 'SCRATCH' in os.environ:
+            from scratch_stager import ScratchStager
+            self.stager = ScratchStager(os.environ['SCRATCH'], dataset_path)
+
+        print("--- flip " + str(self.flip_enabled) + ", rotation " + str(self.rotation) + ", zoom " + str(self.zoom))
         print("--- augmentation " + str(self.is_augment))
+        print("--- sparse labels " + str(self.sparse_labels))
         print(dataset_path)
 
-    def load_files(self):
-        self._fill_split('train')
-        self._fill_split('val')
-        self._fill_split('test')
-
-        # sample for debugging
-        if self._debug_samples > 0:
-            self._data['train'] = self._data['train'][:self._debug_samples]
-            half_debug_samples = int(ceil(self._debug_samples * 0.5))
-            self._data['val'] = self._data['val'][:half_debug_samples]
+    def load_files(self, types=('train', 'val')):
+        """
+        Lists samples of the splits (other splits are listed at their first use)
+        :param tuple types: splits to list right away
+        """
+        self._data = LazySplits(self)
+        for type in types:
+            self._data[type]
 
-        print("training samples %d, validating samples %d, test samples %d" %
-              (len(self._data['train']), len(self._data['val']), len(self._data['test'])))
+        print(", ".join("%s samples %d" % (type, len(self._data[type])) for type in types))
 
         self._files_loaded = True
 
+        if self.stager is not None:
+            # stage in the order the samples are going to be read
+            for type in ['train', 'val']:
+                self.stager.stage(self._sample_paths(type))
+
+    def _sample_paths(self, type):
+        """
+        :return list: all files (images and labels) of the split in order of samples
+        """
+        paths = []
+        for img, label_path in self._data[type]:
+            paths.extend([img] if isinstance(img, str) else img)
+            paths.append(label_path)
+        return paths
+
     @abstractproperty
     def config(self):
         return {'labels': None, 'n_classes': None}
@@ -102,114 +154,383 @@ class BaseDataGenerator:
         """
         pass
 
+    def _load_split(self, type):
+        self._fill_split(type)
+
+        if self.world_size > 1:
+            # splits are shuffled at loading, every rank must index the same order of samples
+            self._data[type].sort(key=lambda sample: sample[1])
+            assert self._shards_disjoint(type), 'Shards 0 and 1 of %s share samples!' % type
+
+        # sample for debugging
+        if self._debug_samples > 0:
+            if type == 'train':
+                self._data[type] = self._data[type][:self._debug_samples]
+            elif type == 'val':
+                self._data[type] = self._data[type][:int(ceil(self._debug_samples * 0.5))]
+
+    def _sample_index(self, which_set, **params):
+        """
+        :param which_set: test | val | train
+        :param params: generator parameters which change the samples
+        :rtype: SampleIndex
+        """
+        return SampleIndex(os.path.join(self.index_dir, self.name), self.dataset_path, which_set, **params)
+
     def shuffle(self, type):
         print("Cityscapes: shuffling dataset")
         random.shuffle(self._data[type])
 
+    def _make_sample(self, type, sample, target_size, out=None):
+        """
+        Builds one sample of a batch
+        :param type: one of [train,val,test]
+        :param sample: item of the split (paths)
+        :param target_size:
+        :param tuple(list, list) out: optional views of the sample in batch arrays (see `BatchPool.build`),
+            inputs and outputs are written right into them where possible
+        :return tuple(list, list): inputs and outputs of the sample
+        """
+        img_path, label_path = sample
+        x, y = out or ([None], [None])
+
+        augment = self._sample_augmentation(type)
+        crop = self._sample_crop(type, target_size)
+
+        img = self._prep_img(type, img_path, target_size, augment, crop)
+        img = self.normalize(img, out=x[0])
+
+        seg_indices = self._prep_gt(type, label_path, target_size, augment, crop)
+        seg_tensor = self.label_target(seg_indices, out=y[0])
+
+        return [img], [seg_tensor]
+
+    @staticmethod
+    def _collate(samples):
+        """
+        Stacks samples into a batch
+        :param list samples: list of (inputs, outputs) from `_make_sample`
+        :return tuple(list, list): batch inputs and outputs
+        """
+        x = [np.asarray(inputs) for inputs in zip(*[inputs for inputs, _ in samples])]
+        y = [np.array(outputs) for outputs in zip(*[outputs for _, outputs in samples])]
+        return x, y
+
+    def shard(self, rank, world_size, seed=2018):
+        """
+        Restricts this generator to one of `world_size` disjoint shards of every split
+        :param int rank: index of the shard (training process)
+        :param int world_size: number of training processes
+        :param int seed: seed of the per-epoch shuffling, must be the same for all ranks
+        """
+        if not 0 <= rank < world_size:
+            raise Exception('Rank %d is out of world size %d!' % (rank, world_size))
+
+        self.rank = rank
+        self.world_size = world_size
+        self.shard_seed = seed
+        print("-- data shard %d/%d" % (rank, world_size))
+
+        # splits loaded before are listed again in the fixed order
+        for type in list(self._data.keys()):
+            self._load_split(type)
+
+    def _shards_disjoint(self, type, epoch=0):
+        """
+        :return bool: if rank 0 and rank 1 get disjoint samples of the split (without padding of the last shards)
+        """
+        labels = [sample[1] for sample in self._data[type]]
+        if self.world_size < 2 or len(labels) < 2:
+            return True
+
+        shard_labels = []
+        for rank in (0, 1):
+            order = ShardSampler(len(labels), rank, self.world_size, self.shard_seed).indices(epoch)
+            # position in the padded permutation is rank + i * world_size
+            shard_labels.append(set(labels[j] for i, j in enumerate(order) if rank + i * self.world_size < len(labels)))
+
+        return not shard_labels[0] & shard_labels[1]
+
+    def use_importance_sampling(self, type='train', uniform=0.3, smoothing=0.5):
+        """
+        Samples of the split are drawn by their training loss in `flow` (see `ImportanceSampler`),
+        losses are fed back by `callbacks.SampleLossFeedback`
+        :param type: one of [train,val,test]
+        :param float uniform: floor of uniform sampling
+        :param float smoothing: weight of the older loss of a sample
+        :rtype: ImportanceSampler
+        """
+        if not 0 <= uniform <= 1:
+            raise Exception('Uniform floor %.2f is out of [0, 1]!' % uniform)
+
+        self._importance[type] = ImportanceSampler(
+            self.data_length(type), self.rank, self.world_size, self.shard_seed, uniform, smoothing
+        )
+        print("-- importance sampling of %s, uniform floor %.2f" % (type, uniform))
+        return self._importance[type]
+
+    def sampler(self, type, shuffle=True):
+        """
+        :param type: one of [train,val,test]
+        :param bool shuffle: reshuffle samples every epoch
+        :rtype: ShardSampler
+        """
+        if type in self._importance:
+            return self._importance[type]
+
+        return ShardSampler(self.data_length(type), self.rank, self.world_size, self.shard_seed, shuffle)
+
+    def _shard_samples(self, type, shuffle=False):
+        """
+        :return: endless iterator over samples of this shard, epoch after epoch
+        """
+        data = self._data[type]
+        return (data[i] for i in self.sampler(type, shuffle).epochs())
+
     @threadsafe_generator
-    def flow(self, type, batch_size, target_size):
+    def flow(self, type, batch_size, target_size, pool_size=0, shuffle=False, threads=0):
         """
         :param type: one of [train,val,test]
         :param batch_size:
         :param target_size:
+        :param int pool_size: if > 0, batches are written into a rotating pool of preallocated arrays,
+            a batch is overwritten after `pool_size` newer batches (must cover e.g. Keras max_queue_size + 2)
+        :param bool shuffle: reshuffle samples every epoch (of this shard)
+        :param int threads: if > 1, samples of a batch are built concurrently by this many threads
+            (OpenCV releases GIL while decoding and computing flow, every thread has its own flow instance)
         :return:
         """
         if not self._files_loaded:
             raise Exception('Files weren\'t loaded first!')
 
-        zipped = itertools.cycle(self._data[type])
-        i = 0
-
-        while True:
-            X = []
-            Y = []
+        data = self._data[type]
+        sampler = self.sampler(type, shuffle)
+        indices = sampler.epochs()
+
+        batch_pool = None
+        if pool_size > 0:
+            from batch_pool import BatchPool
+            batch_pool = BatchPool(pool_size)
+
+        pool = None
+        if threads > 1:
+            from multiprocessing.pool import ThreadPool
+            pool = ThreadPool(threads)
+        map_samples = pool.map if pool is not None else map
+
+        try:
+            while True:
+                batch_indices = [next(indices) for _ in range(batch_size)]
+                if batch_pool is not None:
+                    batch = batch_pool.build(lambda i, out: self._make_sample(type, data[i], target_size, out), batch_indices, map_samples)
+                else:
+                    batch = self._collate(list(map_samples(lambda i: self._make_sample(type, data[i], target_size), batch_indices)))
+                # generator is locked, batches are remembered in the order they are yielded
+                sampler.drawn(batch_indices)
+                yield batch
+        finally:
+            if pool is not None:
+                pool.terminate()
+
+    def sequence(self, type, batch_size, target_size, shuffle=True):
+        """
+        Index-addressable version of `flow` (keras.utils.Sequence), safe for multiple workers
+        :param type: one of [train,val,test]
+        :param batch_size:
+        :param target_size:
+        :param bool shuffle: reshuffle samples after every epoch
+        :rtype: DataSequence
+        """
+        from sequence import DataSequence
+        return DataSequence(self, type, batch_size, target_size, shuffle=shuffle)
 
-            for _ in range(batch_size):
-                img_path, label_path = next(zipped)
+    def flow_parallel(self, type, batch_size, target_size, workers, hold=1, shuffle=False):
+        """
+        Same batches as `flow`, but samples are built by a pool of processes into shared memory.
+        Yielded arrays are views into the ring of batch slots, a slot is rewritten after `hold` newer batches.
+        :param type: one of [train,val,test]
+        :param batch_size:
+        :param target_size:
+        :param int workers: number of processes
+        :param int hold: how many batches the consumer keeps at once (e.g. Keras max_queue_size + 1)
+        :param bool shuffle: reshuffle samples every epoch (of this shard)
+        :rtype: ProcessBatchProducer
+        """
+        if not self._files_loaded:
+            raise Exception('Files weren\'t loaded first!')
 
-                apply_flip = random.randint(0, 1)
+        from batch_producer import ProcessBatchProducer
+        return ProcessBatchProducer(self, type, batch_size, target_size, workers=workers, hold=hold, shuffle=shuffle)
 
-                img = self._prep_img(type, img_path, target_size, apply_flip)
-                img = self.normalize(img, target_size)
-                X.append(img)
+    @threadsafe_generator
+    def flow_clips(self, type, batch_size, target_size, shuffle=False, max_clip_samples=32, pool_size=0):
+        """
+        Same batches as `flow`, but samples are built clip by clip (see `ClipLoader`),
+        so frames and flows shared by more samples are computed once.
+        Samples are sharded once (every `world_size`-th sample of the sorted split, so consecutive frames
+        of a clip stay together), an epoch has `shard_length` samples like in `flow`. Chunks of the shard
+        are reshuffled every epoch.
+        :param type: one of [train,val,test]
+        :param batch_size:
+        :param target_size:
+        :param bool shuffle: reshuffle clips every epoch and samples within them
+        :param int max_clip_samples: samples loaded at once
+        :param int pool_size: see `flow`
+        """
+        if not self._files_loaded:
+            raise Exception('Files weren\'t loaded first!')
 
-                seg_img = self._prep_gt(type, label_path, target_size, apply_flip)
-                seg_tensor = self.one_hot_encoding(seg_img, target_size)
-                Y.append(seg_tensor)
+        from clip_loader import ClipLoader
+        data = self._data[type]
+        shard = ShardSampler(len(data), self.rank, self.world_size, self.shard_seed, shuffle=False).indices()
+        loader = ClipLoader(self, type, target_size, max_samples=max_clip_samples, samples=[data[i] for i in shard])
+        sampler = ShardSampler(len(loader.clips), seed=self.shard_seed, shuffle=shuffle)
 
-            i += 1
+        if pool_size > 0:
+            from batch_pool import BatchPool
+            collate = BatchPool(pool_size).collate
+        else:
+            collate = self._collate
 
-            x = [np.asarray(X)]
-            y = [np.array(Y)]
+        epoch = 0
+        samples = []
+        while True:
+            for sample in loader.epoch(sampler.indices(epoch), shuffle):
+                samples.append(sample)
+                if len(samples) == batch_size:
+                    yield collate(samples)
+                    samples = []
+            epoch += 1
+
+    def _clip_key(self, sample):
+        """
+        :param sample: item of the split
+        :return: clip (sequence) the sample belongs to, frames of a clip are shared by its samples
+        """
+        img = sample[0]
+        return os.path.dirname(img if isinstance(img, str) else img[-1])
 
-            yield x, y
+    @contextmanager
+    def clip_context(self, type, size, frames, flows):
+        """
+        Samples of the split take frames and flows from the loaded clip while in context
+        :param tuple size: (height, width) of frames and flows
+        :param dict frames: resized frames by path
+        :param dict flows: flows by label path of the sample
+        """
+        self._clip_data[type] = (tuple(size), frames, flows)
+        try:
+            yield
+        finally:
+            self._clip_data.pop(type, None)
 
-    def load_data(self, type, batch_size, target_size):
+    def load_data(self, type, batch_size, target_size, out_dir=None, workers=4):
         """
-        Method for loading whole dataset into memory.
-        Won't work on large datasets such as Cityscapes because it would tak a lot of RAM to load.
-        :param type:
-        :param batch_size:
+        Builds every sample of the split exactly once (without augmentation) in a pool of threads
+        and writes it into preallocated arrays, so nothing is accumulated in lists.
+        With `out_dir` the arrays are .npy files opened as memory maps, so even Cityscapes doesn't need to fit in RAM.
+        :param type: one of [train,val,test]
+        :param batch_size: samples handed to the pool at once
         :param target_size:
-        :return:
+        :param str out_dir: directory of the .npy files (arrays are in memory if None)
+        :param int workers: threads building samples
+        :return tuple(list, list): arrays of all inputs and outputs of the split (memory-mapped with out_dir)
         """
-        data = []
-        labs = []
+        from multiprocessing.pool import ThreadPool
         from utils import print_progress
-        # A List of Items
-        data_length = len(self._data[type])
 
-        # Initial call to print 0% progress
-        print_progress(0, data_length, prefix='Progress:', suffix='Complete', bar_length=50)
+        if not self._files_loaded:
+            raise Exception('Files weren\'t loaded first!')
+
+        data = self._data[type]
+        data_length = len(data)
+        if data_length == 0:
+            return [], []
+
+        def allocate(name, i, value):
+            shape = (data_length,) + np.shape(value)
+            dtype = np.asarray(value).dtype
+            if out_dir is None:
+                return np.empty(shape, dtype=dtype)
 
-        for i in range(data_length):
-            img, lab = next(self.flow(type, batch_size, target_size))
-            for b in range(batch_size):
-                data.append(img[b])
-                labs.append(lab[b])
+            return np.lib.format.open_memmap(os.path.join(out_dir, '%s_%s_%d.npy' % (type, name, i)), mode='w+', dtype=dtype, shape=shape)
 
-            # Update Progress Bar
-            print_progress(i + 1, data_length, prefix='Progress:', suffix='Complete', bar_length=50)
+        if out_dir is not None and not os.path.isdir(out_dir):
+            os.makedirs(out_dir)
 
-        return np.array(data), np.array(labs)
+        is_augment = self.is_augment
+        self.is_augment = False
+        pool = ThreadPool(workers)
+
+        try:
+            x, y = None, None
+            print_progress(0, data_length, prefix='Progress:', suffix='Complete', bar_length=50)
+
+            samples = pool.imap(lambda sample: self._make_sample(type, sample, target_size), data, chunksize=batch_size)
+            for i, (inputs, outputs) in enumerate(samples):
+                if x is None:
+                    x = [allocate('x', k, value) for k, value in enumerate(inputs)]
+                    y = [allocate('y', k, value) for k, value in enumerate(outputs)]
+
+                for arr, value in zip(x + y, inputs + outputs):
+                    arr[i] = value
+
+                print_progress(i + 1, data_length, prefix='Progress:', suffix='Complete', bar_length=50)
+        finally:
+            pool.terminate()
+            self.is_augment = is_augment
+
+        if out_dir is not None:
+            for arr in x + y:
+                arr.flush()
+
+        return x, y
 
     def data_length(self, type):
         return len(self._data[type])
 
+    def shard_length(self, type):
+        """
+        :return int: samples of the split in the shard of this generator (see `shard`)
+        """
+        return len(self.sampler(type))
+
     def steps_per_epoch(self, type, batch_size, gpu_count=1):
         """
         From Keras documentation: Total number of steps (batches of samples) to yield from generator before
         declaring one epoch finished and starting the next epoch. It should typically be equal to the number of
         unique samples of your dataset divided by the batch size.
+        Counts samples of the shard only (see `shard`).
         :param type: train | val | test
         :param batch_size:
         :param gpu_count:
         :return:
         """
-        steps = max(1, int(self.data_length(type) // (batch_size * gpu_count)))
+        steps = max(1, int(self.shard_length(type) // (batch_size * gpu_count)))
         return steps
 
-    def _load_img(self, img_path):
+    def _load_img(self, img_path, flags=cv2.IMREAD_COLOR):
         """
         Loads image from path or fails with error
         :param img_path:
+        :param int flags: cv2.imread flags
         :return:
         """
         old_path = img_path
         img_path = self.copy_to_scratch(img_path)
         # try scratch dir (if is found)
-        img = cv2.imread(img_path)
+        img = cv2.imread(img_path, flags)
 
         if img is None:
             print("--- %s not found, trying again in a while" % img_path)
             time.sleep(2)
-            img = cv2.imread(img_path)
+            img = cv2.imread(img_path, flags)
             print("--second attempt (%s) %s" % (img_path, str(img is None)))
 
         # try old path
         if img is None:
             print("--- reading old path %s" % old_path)
-            img = cv2.imread(old_path)
+            img = cv2.imread(old_path, flags)
             print("--third attempt (%s) q%s" % (img_path, str(img is None)))
 
         # raise if file not found
@@ -218,81 +539,347 @@ class BaseDataGenerator:
         return img
 
     def copy_to_scratch(self, img_path):
-        if 'SCRATCH' in os.environ:
-            scratch_dir = os.environ['SCRATCH'] + '/'
-            file_name = os.path.split(img_path)[-1]
-            if not os.path.exists(scratch_dir + file_name):
-                print("-- copying %s to %s" % (os.environ['SCRATCH'] + '/', file_name))
-                shutil.copyfile(img_path, scratch_dir + file_name)
-            else:
-                img_path = scratch_dir + file_name
+        """
+        :return: path in scratch dir if the file is already staged there, original path otherwise
+        """
+        if self.stager is not None:
+            return self.stager.lookup(img_path)
 
         return img_path
 
-    def _prep_img(self, type, img_path, target_size, apply_flip=False):
-        img = cv2.resize(self._load_img(img_path), target_size[::-1])
+    # scales of labels (label size is target_size // sub), see `_prep_gt_scales`
+    gt_sub = [1]
 
-        if self.is_augment and type == 'train':
-            if self.brightness:
-                factor = 1.0 + abs(random.gauss(mu=0.0, sigma=self.brightness))
-                if random.randint(0, 1):
-                    factor = 1.0 / factor
-                table = np.array([((i / 255.0) ** factor) * 255 for i in np.arange(0, 256)]).astype(np.uint8)
-                img = cv2.LUT(img, table)
-
-            if self.flip_enabled and apply_flip:
-                img = cv2.flip(img, 1)
-
-        # if self.rotation:
-        #     angle = random.gauss(mu=0.0, sigma=self.rotation)
-        # else:
-        #     angle = 0.0
-        # if self.zoom:
-        #     scale = random.gauss(mu=1.0, sigma=self.zoom)
-        # else:
-        #     scale = 1.0
-        #
-        # if self.rotation or self.zoom:
-        #     M = cv2.getRotationMatrix2D((img.shape[1] // 2, img.shape[0] // 2), angle, scale)
-        #     img = cv2.warpAffine(img, M, (img.shape[1], img.shape[0]))
+    @property
+    def label_mode(self):
+        return 'sparse' if self.sparse_labels else 'one_hot'
 
+    def use_store(self, root, target_size, types=('train', 'val'), with_flow=False):
+        """
+        Reads samples of given splits from preprocessed memory-mapped store (builds it if missing or outdated)
+        :param str root: directory of stores
+        :param tuple target_size:
+        :param tuple types: splits to be stored
+        :param bool with_flow: store optical flow of samples too
+        """
+        if not self._files_loaded:
+            raise Exception('Files weren\'t loaded first!')
+
+        from tensor_store import TensorStore
+
+        for type in types:
+            store = TensorStore(
+                root, self.name, type, target_size, self.label_mode,
+                label_subs=self.gt_sub,
+                flow_type=self._stored_flow_type() if with_flow else None
+            )
+            if not store.is_valid(self._data[type]):
+                # ranks share the store, only the first one builds it
+                if self.rank == 0:
+                    store.build(self, self._data[type])
+                else:
+                    store.wait(self._data[type])
+            self._stores[type] = store.open()
+
+    def _stored_flow_type(self):
+        """
+        :return str: optical flow type (with resolution if reduced), part of the store key
+        """
+        flow_type = getattr(self, 'optical_flow_type', None)
+        if getattr(self, 'flow_scale', 1.) < 1:
+            flow_type = '%s@%.3f' % (flow_type, self.flow_scale)
+        return flow_type
+
+    def use_cache(self, max_bytes):
+        """
+        Caches decoded and resized images (before augmentation) in memory
+        :param int max_bytes: byte budget of the cache (least recently used images are evicted)
+        """
+        from image_cache import ImageCache
+        self.image_cache = ImageCache(max_bytes)
+        print("-- image cache %.1f MB" % (max_bytes / 2. ** 20))
+
+    def _get_store(self, type, target_size):
+        store = self._stores.get(type)
+        if store is not None and store.target_size == tuple(target_size):
+            return store
+        return None
+
+    def _load_resized(self, type, img_path, target_size):
+        """
+        Loads image resized to target size (from loaded clip, store or cache if available)
+        """
+        clip = self._clip_data.get(type)
+        if clip is not None and clip[0] == tuple(target_size) and img_path in clip[1]:
+            return clip[1][img_path]
+
+        store = self._get_store(type, target_size)
+        if store is not None and store.has_image(img_path):
+            return store.image(img_path)
+
+        if self.image_cache is None:
+            return self._load_img_resized(img_path, target_size)
+
+        key = (img_path, tuple(target_size))
+        img = self.image_cache.get(key)
+        if img is None:
+            img = self.image_cache.put(key, self._load_img_resized(img_path, target_size))
         return img
 
-    def normalize(self, rgb, target_size):
-        if target_size is not None:
-            rgb = cv2.resize(rgb, target_size[::-1])
+    # decode images at 1/2, 1/4 or 1/8 of their size when target size permits (only JPEG has a scaled decoder,
+    # other formats are decoded at full size and resized by OpenCV)
+    reduced_decoding = True
+    _reduced_formats = ('.jpg', '.jpeg')
+    _reduced_flags = [(8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4), (2, cv2.IMREAD_REDUCED_COLOR_2)]
+    # size of dataset images, learned from the first full decode
+    _source_size = None
+
+    def _decode_flags(self, img_path, target_size):
+        """
+        :return int: cv2.imread flags of the smallest decoded size which is not below target size
+        """
+        if self.reduced_decoding and self._source_size is not None and img_path.lower().endswith(self._reduced_formats):
+            for factor, flags in self._reduced_flags:
+                if self._source_size[0] // factor >= target_size[0] and self._source_size[1] // factor >= target_size[1]:
+                    return flags
+        return cv2.IMREAD_COLOR
+
+    def _load_img_resized(self, img_path, target_size):
+        """
+        Decodes image at reduced resolution if possible (falls back to full decode) and resizes it to target size
+        """
+        flags = self._decode_flags(img_path, target_size)
+        img = self._load_img(img_path, flags)
 
-        norm_image = np.zeros_like(rgb, dtype=np.float32)
-        cv2.normalize(rgb, norm_image, alpha=0, beta=1, norm_type=cv2.NORM_MINMAX, dtype=cv2.CV_32F)
-        return norm_image
+        if flags != cv2.IMREAD_COLOR and (img.shape[0] < target_size[0] or img.shape[1] < target_size[1]):
+            # image is smaller than the others of dataset
+            flags = cv2.IMREAD_COLOR
+            img = self._load_img(img_path)
 
-    def _prep_gt(self, type, label_path, target_size, apply_flip=False):
-        seg_img = self._load_img(label_path)
+        if flags == cv2.IMREAD_COLOR:
+            self._source_size = img.shape[:2]
 
+        if img.shape[:2] != tuple(target_size):
+            img = cv2.resize(img, target_size[::-1])
+        return img
+
+    def _sample_augmentation(self, type):
+        """
+        Augmentation parameters of one sample (shared by all its frames, labels and flow)
+        :param type: one of [train,val,test]
+        :rtype: AugmentParams
+        :return: parameters or None when the split isn't augmented
+        """
         if self.is_augment and type == 'train':
-            if self.flip_enabled and apply_flip:
-                seg_img = cv2.flip(seg_img, 1)
+            return self.augmenter.sample()
+        return None
+
+    def set_geometric_augmentation(self, rotation=5.0, zoom=0.1):
+        """
+        Training samples are randomly rotated and zoomed (off by default)
+        :param float rotation: sigma of rotation (degrees)
+        :param float zoom: sigma of zoom (around 1.0)
+        """
+        self.rotation = rotation
+        self.zoom = zoom
+        self.augmenter = Augmenter(flip_enabled=self.flip_enabled, brightness=self.brightness, rotation=rotation, zoom=zoom)
+        print("-- rotation %.1f, zoom %.2f" % (rotation, zoom))
+
+    def set_crop(self, crop_size, scale=1.0):
+        """
+        Training samples become random crops (validation keeps full frames)
+        :param tuple crop_size: (height, width) of crops or None to turn cropping off
+        :param float scale: frames are cropped from target size scaled by it (>= 1)
+        """
+        self.crop_size = tuple(crop_size) if crop_size is not None else None
+        self.crop_scale = scale
+        print("-- random crops %s from frames scaled by %.2f" % (str(self.crop_size), scale))
+
+    def _load_size(self, type, target_size):
+        """
+        :return tuple: size frames of the split are loaded at (larger than target size when cropping)
+        """
+        if self.crop_size is None or type != 'train':
+            return tuple(target_size)
+        return tuple(int(round(a * self.crop_scale)) for a in target_size)
+
+    def _sample_crop(self, type, target_size):
+        """
+        Crop window of one sample (shared by all its frames, labels and flow)
+        :rtype: CropWindow
+        :return: window or None when the split isn't cropped
+        """
+        if self.crop_size is None or type != 'train':
+            return None
+        # labels of all scales are cropped at the same pixels
+        return self.augmenter.crop_window(self._load_size(type, target_size), self.crop_size, align=max(self.gt_sub))
+
+    def _prep_imgs(self, type, img_paths, target_size, augment=None, crop=None):
+        """
+        Loads frames of one sample, augmented all at once
+        :param list img_paths:
+        :param AugmentParams augment: parameters from `_sample_augmentation`
+        :param CropWindow crop: window from `_sample_crop`
+        :return list: uint8 frames of target size (crop size if cropped)
+        """
+        return self._augment_imgs(self._load_imgs(type, img_paths, target_size, crop), augment, crop)
+
+    def _load_imgs(self, type, img_paths, target_size, crop=None):
+        """
+        :return list: uint8 frames without augmentation, of target size (source size of the crop if cropped)
+        """
+        load_size = crop.source_size if crop is not None else target_size
+        return [self._load_resized(type, img_path, load_size) for img_path in img_paths]
+
+    def _augment_imgs(self, imgs, augment=None, crop=None):
+        """
+        :param list imgs: frames from `_load_imgs`
+        :return list: frames cropped and augmented all at once
+        """
+        if crop is not None:
+            imgs = [Augmenter.crop(img, crop) for img in imgs]
+
+        if augment is not None:
+            imgs = self.augmenter.frames(imgs, augment)
 
-        # if self.rotation or self.zoom:
-        #     M = cv2.getRotationMatrix2D((seg_img.shape[1] // 2, seg_img.shape[0] // 2), angle, scale)
-        #     seg_img = cv2.warpAffine(seg_img, M, (seg_img.shape[1], seg_img.shape[0]))
+        return imgs
+
+    def _prep_img(self, type, img_path, target_size, augment=None, crop=None):
+        return self._prep_imgs(type, [img_path], target_size, augment, crop)[0]
+
+    # dtype of normalized inputs (np.float16 halves the memory of queued batches)
+    input_dtype = np.float32
+    # frames are shipped as uint8 and normalized by the model (see `BaseModel.use_uint8_input`)
+    uint8_input = False
+    _normalizer = None
+
+    @property
+    def normalizer(self):
+        """
+        :rtype: Normalizer
+        """
+        if self._normalizer is None:
+            self._normalizer = self._create_normalizer()
+        return self._normalizer
+
+    def _create_normalizer(self):
+        return Normalizer(dtype=self.input_dtype)
+
+    @property
+    def frame_dtype(self):
+        """
+        :return: dtype of frames in batches
+        """
+        return np.uint8 if self.uint8_input else self.input_dtype
+
+    def normalize(self, rgb, target_size=None, out=None):
+        """
+        Resizes (if target size differs) and min-max normalizes image in one pass
+        (uint8 input is only resized, the model normalizes it)
+        :param rgb: uint8 image
+        :param target_size: (height, width) or None to keep size
+        :param out: optional output buffer
+        :return:
+        """
+        if not self.uint8_input:
+            return self.normalizer(rgb, target_size, out=out)
+
+        if target_size is not None and rgb.shape[:2] != tuple(target_size):
+            return cv2.resize(rgb, target_size[::-1], dst=out)
+        if out is None:
+            return rgb
+        out[...] = rgb
+        return out
+
+    # labels are colors by default, datasets with label ids can read just one channel
+    _label_imread_flags = cv2.IMREAD_COLOR
+
+    def _prep_gt(self, type, label_path, target_size, augment=None, crop=None):
+        """
+        :return: uint8 class indices of target size (crop size if cropped)
+        """
+        return self._prep_gt_scales(type, label_path, target_size, [1], augment, crop)[0]
+
+    def _prep_gt_scales(self, type, label_path, target_size, subs, augment=None, crop=None):
+        """
+        Label class indices in more scales, label is decoded, encoded and augmented just once
+        at the finest scale, the others are downsampled from it
+        :param list subs: label size is target_size // sub
+        :param AugmentParams augment: parameters from `_sample_augmentation`
+        :param CropWindow crop: window from `_sample_crop`
+        :return list: uint8 class indices for every sub
+        """
+        load_size = crop.source_size if crop is not None else tuple(target_size)
+        sizes = [tuple(a // sub for a in (crop.size if crop is not None else target_size)) for sub in subs]
+        finest_sub = min(subs)
+
+        store = self._get_store(type, load_size)
+        if store is not None and store.has_label(label_path) and finest_sub in store.label_subs:
+            seg_indices = store.label(label_path, finest_sub)
+        else:
+            seg_img = self._load_img(label_path, self._label_imread_flags)
+            seg_indices = self.label_encoder.encode(seg_img, tuple(a // finest_sub for a in load_size))
+
+        if crop is not None:
+            seg_indices = Augmenter.crop(seg_indices, crop, finest_sub)
+
+        if augment is not None:
+            seg_indices = self.augmenter.labels([seg_indices], augment, self.label_encoder.void_index())[0]
+
+        return LabelEncoder.pyramid(seg_indices, sizes)
+
+    _label_encoder = None
+
+    @property
+    def label_encoder(self):
+        """
+        Lookup table encoder for label images, created on first use
+        :rtype: LabelEncoder
+        """
+        if self._label_encoder is None:
+            self._label_encoder = self._create_label_encoder()
+        return self._label_encoder
 
-        return seg_img
+    def _create_label_encoder(self):
+        return LabelEncoder.from_colors(self.labels)
 
     def one_hot_encoding(self, label_img, target_size):
-        label_img = cv2.cvtColor(label_img, cv2.COLOR_BGR2RGB)
-        label_img = cv2.resize(label_img, target_size[::-1], interpolation=cv2.INTER_NEAREST)
+        indices = self.label_encoder.encode(label_img, target_size)
+        return self.label_encoder.one_hot(indices)
 
-        label_list = []
+    def label_targets(self, seg_indices, out=None):
+        """
+        :param list seg_indices: class indices of all label scales (e.g. from `_prep_gt_scales`)
+        :param list out: optional output buffers of all scales
+        :return list: targets in the label format of the generator
+        """
+        out = out or [None] * len(seg_indices)
+        return [self.label_target(indices, buffer) for indices, buffer in zip(seg_indices, out)]
 
-        for lab in self.labels:
-            label_current = np.all(label_img == lab, axis=2).astype(np.uint8)
-            label_list.append(label_current)
+    def encode_label(self, label_img, target_size):
+        """
+        Encodes label image into the training target
+        :param label_img:
+        :param target_size:
+        :return: uint8 class indices (height, width, 1) for sparse labels, one-hot (height, width, n_classes) otherwise
+        """
+        indices = self.label_encoder.encode(label_img, target_size)
+        return self.label_target(indices)
 
-        label_arr = np.array(label_list)
-        seg_labels = np.rollaxis(label_arr, 0, 3)
+    def label_target(self, indices, out=None):
+        """
+        Training target from class indices (see `encode_label`)
+        :param indices: uint8 class indices (height, width)
+        :param out: optional output buffer of the target shape
+        :return:
+        """
+        if self.sparse_labels:
+            if out is None:
+                return indices[..., np.newaxis]
+            out[..., 0] = indices
+            return out
 
-        return seg_labels
+        return self.label_encoder.one_hot(indices, out=out)
 
     @staticmethod
     def get_color_from_label(class_id_image, n_classes, labels):
@@ -313,9 +900,15 @@ class BaseDataGenerator:
 
 class BaseFlowGenerator(BaseDataGenerator):
     __metaclass__ = ABCMeta
-    optical_flow = None
-
-    def __init__(self, dataset_path, debug_samples=0, flip_enabled=False, rotation=5.0, zoom=0.1, brightness=0.1, optical_flow_type='farn'):
+    # content addressed on-disk cache of computed flows (see `use_flow_cache`)
+    flow_cache = None
+    # pyr_scale, levels, winsize, iterations, poly_n, poly_sigma, flags of Farneback
+    farneback_params = (0.5, 3, 15, 3, 5, 1.2, 0)
+    # fraction of the frame size flow is computed at (see `set_flow_scale`)
+    flow_scale = 1.0
+
+    def __init__(self, dataset_path, debug_samples=0, flip_enabled=False, rotation=0., zoom=0., brightness=0.1, optical_flow_type='farn',
+                 sparse_labels=False):
         if not hasattr(self, 'optical_flow_type'):
             self.optical_flow_type = optical_flow_type
 
@@ -323,13 +916,12 @@ class BaseFlowGenerator(BaseDataGenerator):
 
         if self.optical_flow_type == 'dis':
             print("-- creating optical flow DIS")
-            self.optical_flow = cv2.optflow.createOptFlow_DIS(cv2.optflow.DISOpticalFlow_PRESET_MEDIUM)
         elif self.optical_flow_type == 'deepflow':
             print("-- creating optical flow DeepFlow")
-            self.optical_flow = cv2.optflow.createOptFlow_DeepFlow()
         else:
             print("-- using optical flow Farnenback (default openCV)")
-            pass
+        # OpenCV flow algorithms keep state, so every thread gets its own instance (see `optical_flow`)
+        self._optical_flows = threading.local()
 
         super(BaseFlowGenerator, self).__init__(
             dataset_path,
@@ -337,19 +929,139 @@ class BaseFlowGenerator(BaseDataGenerator):
             flip_enabled=flip_enabled,
             rotation=rotation,
             zoom=zoom,
-            brightness=brightness
+            brightness=brightness,
+            sparse_labels=sparse_labels
         )
 
-    def calc_optical_flow(self, old, new, with_time_difference=False):
-        old_gray = cv2.cvtColor(old, cv2.COLOR_RGB2GRAY)
-        new_gray = cv2.cvtColor(new, cv2.COLOR_RGB2GRAY)
+    @staticmethod
+    def to_gray(img):
+        return cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
+
+    @property
+    def optical_flow(self):
+        """
+        :return: instance of the flow algorithm of the calling thread (None for Farneback)
+        """
+        local = self._optical_flows
+        if not hasattr(local, 'instance'):
+            local.instance = self.create_optical_flow()
+        return local.instance
+
+    def create_optical_flow(self):
+        """
+        :return: new instance of the flow algorithm (None for Farneback, which is a function)
+        """
+        if self.optical_flow_type == 'dis':
+            return cv2.optflow.createOptFlow_DIS(cv2.optflow.DISOpticalFlow_PRESET_MEDIUM)
+        elif self.optical_flow_type == 'deepflow':
+            return cv2.optflow.createOptFlow_DeepFlow()
+        return None
+
+    def flow_stream(self, warm_start=True):
+        """
+        :param bool warm_start: seed the flow with the previous one (DIS only)
+        :rtype: FlowStream
+        """
+        from flow_stream import FlowStream
+        return FlowStream(self, warm_start)
+
+    def use_flow_cache(self, root, max_bytes=None):
+        """
+        Caches computed flows on disk, keyed by content of the frames and the flow algorithm
+        :param str root: directory of the cache (may be shared by more generators and runs)
+        :param int max_bytes: budget of the cache (least recently used flows are removed)
+        """
+        from flow_cache import FlowCache
+        self.flow_cache = FlowCache(root, max_bytes)
+        print("-- flow cache %s (budget %s)" % (root, '%.1f MB' % (max_bytes / 2. ** 20) if max_bytes is not None else 'unlimited'))
+
+    @property
+    def flow_params(self):
+        """
+        :return dict: algorithm and parameters of the flow (part of the cache key)
+        """
+        if self.optical_flow_type == 'dis':
+            return {'type': 'dis', 'preset': 'medium'}
+        if self.optical_flow_type == 'deepflow':
+            return {'type': 'deepflow'}
+        return {'type': 'farn', 'params': list(self.farneback_params)}
+
+    def set_flow_scale(self, scale):
+        """
+        Computes flow at reduced resolution (e.g. of the finest warped layer, see `BaseModel.flow_scale`),
+        it is upscaled back to the frame size with vectors scaled accordingly
+        :param float scale: fraction of the frame size (1.0 = full size)
+        """
+        self.flow_scale = min(1., float(scale))
+        print("-- optical flow computed at %.3f of frame size" % self.flow_scale)
+
+    def _compute_gray_flow(self, old_gray, new_gray, optical_flow=None, initial=None):
+        """
+        :param optical_flow: instance of the flow algorithm (the one of the calling thread by default)
+        :param initial: initial flow estimate (used by DIS, see `FlowStream`)
+        """
+        optical_flow = optical_flow or self.optical_flow
+        if optical_flow is not None:
+            return optical_flow.calc(old_gray, new_gray, initial)
+
+        return cv2.calcOpticalFlowFarneback(old_gray, new_gray, None, *self.farneback_params)
+
+    def _reduced_size(self, gray):
+        """
+        :return tuple: (width, height) flow is computed at for the frame
+        """
+        height, width = gray.shape[:2]
+        return max(1, int(round(width * self.flow_scale))), max(1, int(round(height * self.flow_scale)))
+
+    def _reduce_gray(self, gray):
+        if self.flow_scale >= 1:
+            return gray
+        return cv2.resize(gray, self._reduced_size(gray), interpolation=cv2.INTER_AREA)
+
+    @staticmethod
+    def _expand_flow(flow, size):
+        """
+        :param flow: flow computed at reduced size (vectors in its pixels)
+        :param tuple size: (height, width) of frames
+        :return: flow of frame size
+        """
+        height, width = size
+        if flow.shape[:2] == (height, width):
+            return flow
+
+        reduced_height, reduced_width = flow.shape[:2]
+        flow = cv2.resize(flow, (width, height), interpolation=cv2.INTER_LINEAR)
+        flow[..., 0] *= width / float(reduced_width)
+        flow[..., 1] *= height / float(reduced_height)
+        return flow
+
+    def calc_gray_flow(self, old_gray, new_gray, cache=True):
+        """
+        :param old_gray:
+        :param new_gray:
+        :param bool cache: use the flow cache (if enabled), frames that never repeat shouldn't be cached
+        :return: flow (height, width, 2)
+        """
+        flow = self._cached_gray_flow(self._reduce_gray(old_gray), self._reduce_gray(new_gray), cache)
+        return self._expand_flow(flow, old_gray.shape[:2])
+
+    def _cached_gray_flow(self, old_gray, new_gray, cache=True):
+        if self.flow_cache is None or not cache:
+            return self._compute_gray_flow(old_gray, new_gray)
+
+        key = self.flow_cache.key(old_gray, new_gray, self.flow_params)
+        flow = self.flow_cache.get(key)
+        if flow is None:
+            flow = self.flow_cache.put(key, self._compute_gray_flow(old_gray, new_gray))
+        return flow
+
+    def calc_optical_flow(self, old, new, with_time_difference=False, cache=True):
+        old_gray = self.to_gray(old)
+        new_gray = self.to_gray(new)
 
         start = datetime.datetime.now()
 
-        if self.optical_flow is not None:
-            flow = self.optical_flow.calc(old_gray, new_gray, None)
-        else:
-            flow = cv2.calcOpticalFlowFarneback(old_gray, new_gray, None, 0.5, 3, 15, 3, 5, 1.2, 0)
+        flow = self.calc_gray_flow(old_gray, new_gray, cache)
 
         end = datetime.datetime.now()
         diff = end - start
@@ -359,40 +1071,67 @@ class BaseFlowGenerator(BaseDataGenerator):
         else:
             return flow
 
-    @threadsafe_generator
-    def flow(self, type, batch_size, target_size):
-        if not self._files_loaded:
-            raise Exception('Files weren\'t loaded first!')
-
-        zipped = itertools.cycle(self._data[type])
+    def _make_sample(self, type, sample, target_size, out=None):
+        (img_old_path, img_new_path), label_path = sample
+        x, y = out or ([None] * 3, [None])
+        crop = self._sample_crop(type, target_size)
 
-        while True:
-            input1_arr = []
-            input2_arr = []
-            flow_arr = []
-            out_arr = []
-
-            for _ in range(batch_size):
-                (img_old_path, img_new_path), label_path = next(zipped)
+        frames = self._load_imgs(type, [img_old_path, img_new_path], target_size, crop)
+        img, img2 = self._augment_imgs(frames, crop=crop)
+        flow = self._sample_flow(type, label_path, img2, img, target_size, crop=crop, frames=frames)
 
-                img = cv2.resize(self._load_img(img_old_path), target_size[::-1])
-                img2 = cv2.resize(self._load_img(img_new_path), target_size[::-1])
-                flow = self.calc_optical_flow(img2, img)
+        input1 = self.normalize(img, target_size=None, out=x[0])
+        input2 = self.normalize(img2, target_size=None, out=x[1])
 
-                input1 = self.normalize(img, target_size=None)
-                input2 = self.normalize(img2, target_size=None)
+        seg_indices = self._prep_gt(type, label_path, target_size, crop=crop)
+        seg_tensor = self.label_target(seg_indices, out=y[0])
 
-                input1_arr.append(input1)
-                input2_arr.append(input2)
-                flow_arr.append(flow)
+        return [input1, input2, flow], [seg_tensor]
 
-                seg_tensor = cv2.imread(label_path)
-                seg_tensor = self.one_hot_encoding(seg_tensor, target_size)
-                out_arr.append(seg_tensor)
-
-            x = [np.asarray(input1_arr), np.asarray(input2_arr), np.asarray(flow_arr)]
-            y = np.array(out_arr)
-            yield x, y
+    def _sample_flow(self, type, label_path, new, old, target_size, augment=None, crop=None, frames=None):
+        """
+        Optical flow of the sample, precomputed (from frames without augmentation) in loaded clip or store,
+        or from the flow cache
+        :param label_path: label of the sample
+        :param new: augmented frame
+        :param old: augmented frame
+        :param AugmentParams augment: parameters the frames were augmented with
+        :param CropWindow crop: window the frames were cropped with
+        :param tuple frames: (old, new) frames without augmentation (from `_load_imgs`), lets augmented samples
+            use cached flow
+        :return:
+        """
+        load_size = crop.source_size if crop is not None else target_size
+        flow = self._precomputed_flow(type, label_path, load_size)
+        if flow is None:
+            augmented = augment is not None or crop is not None
+            if not augmented or self.flow_cache is None or frames is None:
+                # flow of randomly augmented frames is never requested again
+                return self.calc_optical_flow(new, old, cache=not augmented)
+
+            # cached flow of frames without augmentation is augmented the same way as the frames
+            old_img, new_img = frames
+            flow = self.calc_optical_flow(new_img, old_img)
+
+        if crop is not None:
+            flow = Augmenter.crop(flow, crop)
+
+        if augment is not None:
+            flow = self.augmenter.flow(flow, augment)
+        return flow
+
+    def _precomputed_flow(self, type, label_path, target_size):
+        """
+        :return: flow of the sample from loaded clip or store (of frames without augmentation) or None
+        """
+        clip = self._clip_data.get(type)
+        if clip is not None and clip[0] == tuple(target_size) and label_path in clip[2]:
+            return clip[2][label_path]
+
+        store = self._get_store(type, target_size)
+        if store is not None and store.has_flow(label_path):
+            return np.array(store.flow(label_path))
+        return None
 
     @staticmethod
     def flow_to_bgr(flow, target_size):
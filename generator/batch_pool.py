@@ -0,0 +1,91 @@
+import numpy as np
+
+
+class BatchPool:
+    """
+    Small rotating pool of preallocated batch arrays.
+
+    Samples are built right into the arrays of the next slot (see `build`) instead of stacking them into
+    newly allocated batches. Slot is reused after `size` batches, so the pool must be larger than the number of batches
+    the consumer keeps at once (e.g. Keras queue).
+    """
+
+    def __init__(self, size):
+        """
+        :param int size: number of slots
+        """
+        self.size = max(1, size)
+        self._slots = None
+        self._next = 0
+
+    def _allocate(self, batch_size, sample):
+        inputs, outputs = sample
+        self._slots = [
+            (
+                [np.empty((batch_size,) + np.shape(value), dtype=np.asarray(value).dtype) for value in inputs],
+                [np.empty((batch_size,) + np.shape(value), dtype=np.asarray(value).dtype) for value in outputs],
+            )
+            for _ in range(self.size)
+        ]
+
+    def _next_slot(self, batch_size, sample):
+        if self._slots is None or len(self._slots[0][0][0]) != batch_size:
+            self._allocate(batch_size, sample)
+
+        slot = self._slots[self._next]
+        self._next = (self._next + 1) % self.size
+        return slot
+
+    @staticmethod
+    def views(slot, i):
+        """
+        :param tuple slot: batch inputs and outputs
+        :param int i: index of the sample in the batch
+        :return tuple(list, list): views of the sample in the arrays of the slot (`out` of `_make_sample`)
+        """
+        x, y = slot
+        return [arr[i] for arr in x], [arr[i] for arr in y]
+
+    @staticmethod
+    def write(sample, views):
+        """
+        Copies values of the sample which weren't written into their views in place
+        """
+        for values, arrs in zip(sample, views):
+            for value, arr in zip(values, arrs):
+                if value is not arr:
+                    arr[...] = value
+
+    def build(self, make_sample, items, map=map):
+        """
+        Builds samples right into the arrays of the next slot
+        :param callable make_sample: (item, out) -> (inputs, outputs), `out` are views of the sample in the slot
+            (None for the first sample, which gives shapes of the slot arrays)
+        :param list items: items of the batch
+        :param callable map: map used to build the samples (e.g. of a thread pool)
+        :return tuple(list, list): batch inputs and outputs (arrays of the slot)
+        """
+        first = None
+        if self._slots is None or len(self._slots[0][0][0]) != len(items):
+            first = make_sample(items[0], None)
+
+        slot = self._next_slot(len(items), first)
+
+        def build_sample(i):
+            views = self.views(slot, i)
+            sample = first if i == 0 and first is not None else make_sample(items[i], views)
+            self.write(sample, views)
+
+        list(map(build_sample, range(len(items))))
+        return slot
+
+    def collate(self, samples):
+        """
+        Writes samples built elsewhere into the next slot
+        :param list samples: list of (inputs, outputs) from `_make_sample`
+        :return tuple(list, list): batch inputs and outputs (arrays of the slot)
+        """
+        slot = self._next_slot(len(samples), samples[0])
+        for i, sample in enumerate(samples):
+            self.write(sample, self.views(slot, i))
+        return slot
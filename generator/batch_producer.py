@@ -0,0 +1,185 @@
+import ctypes
+import itertools
+import multiprocessing
+import random
+import threading
+import traceback
+from collections import deque
+from multiprocessing.sharedctypes import RawArray
+
+import numpy as np
+
+from batch_pool import BatchPool
+
+
+def _worker_loop(datagen, type, target_size, buffers, n_inputs, tasks, done, seed):
+    """
+    Builds samples from the task queue and writes them into their batch slot in shared memory
+    """
+    # every worker needs its own random augmentations
+    random.seed(seed)
+    np.random.seed(seed % (2 ** 32))
+
+    arrays = [ProcessBatchProducer.as_array(buffer) for buffer in buffers]
+    if datagen.stager is not None:
+        datagen.stager.readonly = True
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+
+        slot, i, sample = task
+        try:
+            views = [arr[slot, i] for arr in arrays[:n_inputs]], [arr[slot, i] for arr in arrays[n_inputs:]]
+            BatchPool.write(datagen._make_sample(type, sample, target_size, views), views)
+            done.put((slot, None))
+        except Exception:
+            done.put((slot, traceback.format_exc()))
+
+
+def _session_exists():
+    """
+    :return bool: if Keras already created TensorFlow session (its threads and devices don't survive fork)
+    """
+    try:
+        from keras.backend import tensorflow_backend
+    except ImportError:
+        return False
+    return getattr(tensorflow_backend, '_SESSION', None) is not None
+
+
+class ProcessBatchProducer:
+    """
+    Batch iterator which fans out sample construction (decoding, resizing, optical flow, label encoding)
+    over a pool of processes.
+
+    Workers write finished samples directly into a preallocated ring of batch slots in shared memory,
+    so nothing is pickled on the way back. Yielded arrays are views into the ring and the slot is rewritten
+    only after `hold` newer batches were taken, which must cover everything the consumer keeps at once.
+    Workers are forked, so the producer has to be created before TensorFlow session (see `Trainer.fit_model`).
+    """
+
+    def __init__(self, datagen, type, batch_size, target_size, workers=4, prefetch=None, hold=1, shuffle=False):
+        """
+        :param BaseDataGenerator datagen: generator with loaded files
+        :param str type: one of [train,val,test]
+        :param int batch_size:
+        :param tuple target_size:
+        :param int workers: number of processes
+        :param int prefetch: batches being built at once (default 2 per worker)
+        :param int hold: batches the consumer keeps at once
+        :param bool shuffle: reshuffle samples every epoch (of the shard of datagen)
+        """
+        self.batch_size = batch_size
+        self.workers = workers
+        self.hold = max(1, hold)
+        self.prefetch = prefetch or 2 * workers
+        self.ring_size = self.prefetch + self.hold
+
+        self._samples = datagen._shard_samples(type, shuffle)
+        self._lock = threading.Lock()
+
+        # probe shapes of the sample in this process and allocate the ring for every input and output
+        first = next(self._samples)
+        inputs, outputs = datagen._make_sample(type, first, target_size)
+        self._n_inputs = len(inputs)
+        self._buffers = [self._allocate(np.asarray(a)) for a in inputs + outputs]
+        self._arrays = [self.as_array(buffer) for buffer in self._buffers]
+        self._samples = itertools.chain([first], self._samples)
+
+        print("-- ProcessBatchProducer: %d workers, ring of %d batches (%.1f MB)" % (
+            self.workers, self.ring_size, sum(arr.nbytes for arr in self._arrays) / 2. ** 20))
+
+        if _session_exists():
+            raise Exception('TensorFlow session already exists, batch producer must fork its workers before it!')
+
+        self._tasks = multiprocessing.Queue()
+        self._done = multiprocessing.Queue()
+        self._processes = []
+        seed = random.randint(0, 2 ** 31)
+        # copying threads of the stager may hold locks, which would stay locked in forked workers
+        if datagen.stager is not None:
+            datagen.stager.stop()
+        try:
+            for w in range(workers):
+                process = multiprocessing.Process(
+                    target=_worker_loop,
+                    args=(datagen, type, target_size, self._buffers, self._n_inputs, self._tasks, self._done, seed + w)
+                )
+                process.daemon = True
+                process.start()
+                self._processes.append(process)
+        finally:
+            if datagen.stager is not None:
+                datagen.stager.start()
+
+        self._pending = [0] * self.ring_size
+        # first error of every slot, raised when the slot is taken
+        self._errors = {}
+        self._in_flight = deque()
+        self._held = deque()
+
+        for slot in range(self.ring_size):
+            self._submit(slot)
+
+    def _allocate(self, sample_arr):
+        shape = (self.ring_size, self.batch_size) + sample_arr.shape
+        raw = RawArray(ctypes.c_byte, int(np.prod(shape)) * sample_arr.dtype.itemsize)
+        return raw, shape, sample_arr.dtype.str
+
+    @staticmethod
+    def as_array(buffer):
+        """
+        :param tuple buffer: (raw shared array, shape, dtype)
+        :rtype: np.ndarray
+        """
+        raw, shape, dtype = buffer
+        return np.frombuffer(raw, dtype=np.dtype(dtype)).reshape(shape)
+
+    def _submit(self, slot):
+        for i in range(self.batch_size):
+            self._tasks.put((slot, i, next(self._samples)))
+        self._pending[slot] = self.batch_size
+        self._in_flight.append(slot)
+
+    def _wait(self, slot):
+        while self._pending[slot] > 0:
+            done_slot, error = self._done.get()
+            self._pending[done_slot] -= 1
+            if error is not None:
+                self._errors.setdefault(done_slot, error)
+
+        error = self._errors.pop(slot, None)
+        if error is not None:
+            # no worker writes into the slot anymore, it is refilled so the ring keeps its size
+            self._submit(slot)
+            raise Exception("Sample failed in worker process:\n%s" % error)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        with self._lock:
+            slot = self._in_flight.popleft()
+            self._wait(slot)
+
+            # the oldest slot isn't used by the consumer anymore
+            self._held.append(slot)
+            if len(self._held) > self.hold:
+                self._submit(self._held.popleft())
+
+            x = [arr[slot] for arr in self._arrays[:self._n_inputs]]
+            y = [arr[slot] for arr in self._arrays[self._n_inputs:]]
+            return x, y
+
+    __next__ = next
+
+    def close(self):
+        for _ in self._processes:
+            self._tasks.put(None)
+        for process in self._processes:
+            process.join(timeout=1)
+            if process.is_alive():
+                process.terminate()
+        self._processes = []
@@ -9,17 +9,27 @@ from camvid_generator import CamVidGenerator
 
 
 class CamVidFlowGenerator(CamVidGenerator, BaseFlowGenerator):
+    def __init__(self, dataset_path, debug_samples=0, optical_flow_type='farn', sparse_labels=False):
+        self.optical_flow_type = optical_flow_type
+        super(CamVidFlowGenerator, self).__init__(dataset_path, debug_samples=debug_samples, sparse_labels=sparse_labels)
+
     def _fill_split(self, which_set):
         img_path = os.path.join(self.dataset_path, '701_StillsRaw_full/', )
         lab_path = os.path.join(self.dataset_path, 'LabeledApproved_full/', )
 
-        filenames = []
         if which_set == 'train':
-            filenames += self._make_pairs(img_path, lab_path, '0016E5_')
-            filenames += self._make_pairs(img_path, lab_path, 'Seq05VD_')
-            filenames += self._make_pairs(img_path, lab_path, '0006R0_')
+            prefixes = ['0016E5_', 'Seq05VD_', '0006R0_']
         elif which_set == 'val':
-            filenames += self._make_pairs(img_path, lab_path, '0001TP_')
+            prefixes = ['0001TP_']
+        else:
+            prefixes = []
+
+        # sequences are globbed again only if the directories changed
+        index = self._sample_index(which_set, pairs=True)
+        filenames = []
+        for prefix in prefixes:
+            filenames += index.samples(prefix, [img_path, lab_path], lambda: list(self._make_pairs(img_path, lab_path, prefix)))
+        index.save()
 
         random.shuffle(filenames)
 
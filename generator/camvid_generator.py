@@ -57,27 +57,37 @@ class CamVidGenerator(BaseDataGenerator):
             'n_classes': len(self._config['labels'])
         }
 
-    def __init__(self, dataset_path, debug_samples=0):
+    def __init__(self, dataset_path, debug_samples=0, sparse_labels=False):
         dataset_path = os.path.join(dataset_path, 'camvid/')
-        super(CamVidGenerator, self).__init__(dataset_path, debug_samples)
+        super(CamVidGenerator, self).__init__(dataset_path, debug_samples, sparse_labels=sparse_labels)
 
     def _fill_split(self, which_set):
         img_path = os.path.join(self.dataset_path, '701_StillsRaw_full/', )
         lab_path = os.path.join(self.dataset_path, 'LabeledApproved_full/', )
 
-        filenames = []
         if which_set == 'train':
-            filenames += self._get_files(img_path, lab_path, '0016E5_')
-            filenames += self._get_files(img_path, lab_path, 'Seq05VD_')
-            filenames += self._get_files(img_path, lab_path, '0006R0_')
+            prefixes = ['0016E5_', 'Seq05VD_', '0006R0_']
         elif which_set == 'val':
-            filenames += self._get_files(img_path, lab_path, '0001TP_')
+            prefixes = ['0001TP_']
+        else:
+            prefixes = []
+
+        # sequences are globbed again only if the directories changed
+        index = self._sample_index(which_set)
+        filenames = []
+        for prefix in prefixes:
+            filenames += index.samples(prefix, [img_path, lab_path], lambda: list(self._get_files(img_path, lab_path, prefix)))
+        index.save()
 
         random.shuffle(filenames)
 
         print('CamVid: ' + which_set + ' ' + str(len(filenames)) + ' files')
         self._data[which_set] = filenames
 
+    def _clip_key(self, sample):
+        # sequence prefix (e.g. 0016E5)
+        return os.path.basename(sample[1]).split('_')[0]
+
     def _get_files(self, img_path, lab_path, prefix):
         img_files = glob.glob(img_path + prefix + "*.png")
         img_files.sort()
@@ -1,71 +1,41 @@
-import itertools
-
 import cv2
-import numpy as np
-import random
 
-from base_generator import BaseFlowGenerator, threadsafe_generator
+from base_generator import BaseFlowGenerator
 from cityscapes_generator import CityscapesGenerator
 
 
 class CityscapesFlowGenerator(CityscapesGenerator, BaseFlowGenerator):
-    def __init__(self, dataset_path, debug_samples=0, how_many_prev=1, prev_skip=0, flip_enabled=False, optical_flow_type='farn'):
+    def __init__(self, dataset_path, debug_samples=0, how_many_prev=1, prev_skip=0, flip_enabled=False, optical_flow_type='farn', sparse_labels=False):
         self.optical_flow_type = optical_flow_type
         super(CityscapesFlowGenerator, self).__init__(
             dataset_path=dataset_path,
             debug_samples=debug_samples,
             how_many_prev=how_many_prev,
             prev_skip=prev_skip,
-            flip_enabled=flip_enabled
+            flip_enabled=flip_enabled,
+            sparse_labels=sparse_labels
         )
 
-    @threadsafe_generator
-    def flow(self, type, batch_size, target_size):
-        if not self._files_loaded:
-            raise Exception('Files weren\'t loaded first!')
-
-        zipped = itertools.cycle(self._data[type])
-        i = 0
-
-        while True:
-            Y = []
-
-            input1_arr = []
-            input2_arr = []
-            flow_arr = []
-
-            for _ in range(batch_size):
-                (img_old_path, img_new_path), label_path = next(zipped)
-
-                apply_flip = random.randint(0, 1)
-
-                img_old = self._prep_img(type, img_old_path, target_size, apply_flip)
-                img_new = self._prep_img(type, img_new_path, target_size, apply_flip)
-
-                # reverse flow
-                flow = self.calc_optical_flow(img_new, img_old)
-                flow_arr.append(flow)
+    def _make_sample(self, type, sample, target_size, out=None):
+        (img_old_path, img_new_path), label_path = sample
+        x, y = out or ([None] * 3, [None])
 
-                input1 = self.normalize(img_old, target_size=None)
-                input1_arr.append(input1)
+        augment = self._sample_augmentation(type)
+        crop = self._sample_crop(type, target_size)
 
-                input2 = self.normalize(img_new, target_size=None)
-                input2_arr.append(input2)
+        frames = self._load_imgs(type, [img_old_path, img_new_path], target_size, crop)
+        img_old, img_new = self._augment_imgs(frames, augment, crop)
 
-                seg_img = self._prep_gt(type, label_path, target_size, apply_flip)
-                seg_tensor = self.one_hot_encoding(seg_img, target_size)
-                Y.append(seg_tensor)
+        # reverse flow
+        flow = self._sample_flow(type, label_path, img_new, img_old, target_size, augment, crop, frames=frames)
 
-            i += 1
+        input1 = self.normalize(img_old, target_size=None, out=x[0])
+        input2 = self.normalize(img_new, target_size=None, out=x[1])
 
-            x = [
-                np.asarray(input1_arr),
-                np.asarray(input2_arr),
-                np.asarray(flow_arr)
-            ]
+        seg_indices = self._prep_gt(type, label_path, target_size, augment, crop)
+        seg_tensor = self.label_target(seg_indices, out=y[0])
 
-            y = [np.array(Y)]
-            yield x, y
+        return [input1, input2, flow], [seg_tensor]
 
 
 if __name__ == '__main__':
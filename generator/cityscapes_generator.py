@@ -5,11 +5,12 @@ import cv2
 
 import cityscapes_labels
 from base_generator import BaseDataGenerator
-import numpy as np
+from label_encoding import LabelEncoder
+from preprocessing import Normalizer
 
 
 class CityscapesGenerator(BaseDataGenerator):
-    def __init__(self, dataset_path, debug_samples=0, how_many_prev=0, prev_skip=0, old_labels=False, flip_enabled=False):
+    def __init__(self, dataset_path, debug_samples=0, how_many_prev=0, prev_skip=0, old_labels=False, flip_enabled=False, sparse_labels=False):
         dataset_path = os.path.join(dataset_path, 'cityscapes/')
         self._file_pattern = re.compile("(?P<city>[^_]*)_(?:[^_]+)_(?P<frame>[^_]+)_gtFine_labelIds\.png")
         self._how_many_prev = how_many_prev
@@ -18,7 +19,8 @@ class CityscapesGenerator(BaseDataGenerator):
         super(CityscapesGenerator, self).__init__(
             dataset_path,
             debug_samples,
-            flip_enabled=flip_enabled
+            flip_enabled=flip_enabled,
+            sparse_labels=sparse_labels
         )
 
     _city_labels = [lab.color for lab in cityscapes_labels.labels]
@@ -44,39 +46,18 @@ class CityscapesGenerator(BaseDataGenerator):
         return self._config
 
     def _fill_split(self, which_set):
-        img_path = os.path.join(self.dataset_path, 'leftImg8bit', which_set, '')
-        lab_path = os.path.join(self.dataset_path, 'gtFine', which_set, '')
+        lab_path = os.path.join(self.dataset_path, 'gtFine', which_set)
+        index = self._sample_index(which_set, how_many_prev=self._how_many_prev, prev_skip=self._prev_skip)
 
-        # Get file names for this set
+        # Get file names for this set, cities are rescanned only if their directory changed
         filenames = []
-        for root, dirs, files in os.walk(lab_path):
-            for gt_name in files:
-                if gt_name.startswith('._') or not (gt_name.endswith('_labelIds.png')):
-                    continue
-
-                match = self._file_pattern.match(gt_name)
-                if match is None:
-                    print("skipping path %s" % path)
-                    continue
-
-                match_dict = match.groupdict()
-                frame_i = int(match_dict['frame'])
-
-                img_name = os.path.join(img_path, match_dict['city'], gt_name)
-                if self._how_many_prev == 0:
-                    i_batch = img_name.replace("gtFine_labelIds", "leftImg8bit")
-                else:
-                    i_batch = []
-                    for i in range(frame_i - self._how_many_prev - self._prev_skip, frame_i - self._prev_skip):
-                        frame_str = str(i).zfill(6)
-                        name_i = img_name \
-                            .replace(match_dict['frame'], frame_str) \
-                            .replace("gtFine_labelIds", "leftImg8bit")
-                        i_batch.append(name_i)
-
-                    i_batch.append(img_name.replace("gtFine_labelIds", "leftImg8bit"))
-
-                filenames.append((i_batch, os.path.join(root, gt_name)))
+        cities = sorted(os.listdir(lab_path)) if os.path.isdir(lab_path) else []
+        for city in cities:
+            city_path = os.path.join(lab_path, city)
+            if os.path.isdir(city_path):
+                filenames += index.samples(city, [city_path], lambda: self._scan_city(which_set, city_path))
+
+        index.save()
 
         print('Cityscapes: ' + which_set + ' ' + str(len(filenames)) + ' files')
         self._data[which_set] = filenames
@@ -84,25 +65,58 @@ class CityscapesGenerator(BaseDataGenerator):
         if not self._debug_samples:
             self.shuffle(which_set)
 
-    def one_hot_encoding(self, label_img, target_size):
-        label_img = cv2.cvtColor(label_img, cv2.COLOR_BGR2RGB)
-        label_img = cv2.resize(label_img, target_size[::-1], interpolation=cv2.INTER_NEAREST)
+    def _scan_city(self, which_set, city_path):
+        """
+        :param which_set: test | val | train
+        :param city_path: directory of city labels
+        :return list: samples of the city
+        """
+        img_path = os.path.join(self.dataset_path, 'leftImg8bit', which_set, '')
+
+        filenames = []
+        for gt_name in sorted(os.listdir(city_path)):
+            if gt_name.startswith('._') or not (gt_name.endswith('_labelIds.png')):
+                continue
+
+            match = self._file_pattern.match(gt_name)
+            if match is None:
+                print("skipping path %s" % gt_name)
+                continue
+
+            match_dict = match.groupdict()
+            frame_i = int(match_dict['frame'])
+
+            img_name = os.path.join(img_path, match_dict['city'], gt_name)
+            if self._how_many_prev == 0:
+                i_batch = img_name.replace("gtFine_labelIds", "leftImg8bit")
+            else:
+                i_batch = []
+                for i in range(frame_i - self._how_many_prev - self._prev_skip, frame_i - self._prev_skip):
+                    frame_str = str(i).zfill(6)
+                    name_i = img_name \
+                        .replace(match_dict['frame'], frame_str) \
+                        .replace("gtFine_labelIds", "leftImg8bit")
+                    i_batch.append(name_i)
+
+                i_batch.append(img_name.replace("gtFine_labelIds", "leftImg8bit"))
+
+            filenames.append((i_batch, os.path.join(city_path, gt_name)))
+
+        return filenames
 
-        label_list = []
-        for lab in self._city_labels_struct:
-            label_current = np.all(label_img == lab.id, axis=2).astype(np.uint8)
-            label_list.append(label_current)
+    def _clip_key(self, sample):
+        # city and sequence number (e.g. aachen_000012)
+        label_name = os.path.basename(sample[1])
+        return tuple(label_name.split('_')[:2])
 
-        label_arr = np.array(label_list)
-        seg_labels = np.rollaxis(label_arr, 0, 3)
+    # labelIds are stored in one channel
+    _label_imread_flags = cv2.IMREAD_GRAYSCALE
 
-        return seg_labels
+    def _create_label_encoder(self):
+        return LabelEncoder.from_ids([lab.id for lab in self._city_labels_struct])
 
-    def normalize(self, rgb, target_size):
-        norm = super(CityscapesGenerator, self).normalize(rgb, target_size)
-        norm -= self._config['mean']
-        norm /= self._config['std']
-        return norm
+    def _create_normalizer(self):
+        return Normalizer(self._config['mean'], self._config['std'], dtype=self.input_dtype)
 
     def denormalize(self, rgb):
         rgb *= self._config['std']
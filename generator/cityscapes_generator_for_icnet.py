@@ -1,62 +1,23 @@
-import itertools
-import random
-
 import cv2
-import numpy as np
 
 from cityscapes_generator import CityscapesGenerator
-from base_generator import threadsafe_generator
 
 
 class CityscapesGeneratorForICNet(CityscapesGenerator):
     gt_sub = [4, 8, 16]
 
-    @threadsafe_generator
-    def flow(self, type, batch_size, target_size):
-        """
-        :param type: one of [train,val,test]
-        :param batch_size:
-        :param target_size:
-        :return:
-        """
-        if not self._files_loaded:
-            raise Exception('Files weren\'t loaded first!')
-
-        zipped = itertools.cycle(self._data[type])
-        i = 0
-
-        while True:
-            X = [[]] * 1
-
-            Y = []
-            Y2 = []
-            Y3 = []
-
-            for _ in range(batch_size):
-                img_path, label_path = next(zipped)
-                apply_flip = self.flip_enabled and random.randint(0, 1)
-
-                img = self._prep_img(type, img_path, target_size, apply_flip)
-                img = self.normalize(img, target_size)
-
-                X[0].append(img)
-
-                seg_img = self._prep_gt(type, label_path, target_size, apply_flip)
-
-                seg_tensor = self.one_hot_encoding(seg_img, tuple(a // 4 for a in target_size))  # target_size)
-                Y.append(seg_tensor)
-
-                seg_tensor2 = self.one_hot_encoding(seg_img, tuple(a // 8 for a in target_size))
-                Y2.append(seg_tensor2)
+    def _make_sample(self, type, sample, target_size, out=None):
+        img_path, label_path = sample
+        x, y = out or ([None], None)
+        augment = self._sample_augmentation(type)
+        crop = self._sample_crop(type, target_size)
 
-                seg_tensor3 = self.one_hot_encoding(seg_img, tuple(a // 16 for a in target_size))
-                Y3.append(seg_tensor3)
+        img = self._prep_img(type, img_path, target_size, augment, crop)
+        img = self.normalize(img, out=x[0])
 
-            i += 1
+        seg_indices = self._prep_gt_scales(type, label_path, target_size, self.gt_sub, augment, crop)
 
-            x = [np.asarray(j) for j in X]
-            y = [np.array(Y), np.array(Y2), np.array(Y3)]
-            yield x, y
+        return [img], self.label_targets(seg_indices, out=y)
 
 
 if __name__ == '__main__':
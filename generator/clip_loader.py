@@ -0,0 +1,102 @@
+import random
+from collections import OrderedDict
+
+
+class ClipLoader:
+    """
+    Builds samples clip by clip, so frames shared by more samples of a sequence are decoded once.
+
+    Samples of a split are grouped by their clip (city sequence, CamVid sequence, see `_clip_key`) and split
+    into chunks of consecutive samples. For every chunk the frames are loaded and resized once, each frame is
+    converted to grayscale once and optical flow of every frame pair referenced by the samples is computed once.
+    Samples are then built by the usual `_make_sample`, which takes frames and flow from the loaded chunk.
+    """
+
+    def __init__(self, datagen, type, target_size, max_samples=32, samples=None):
+        """
+        :param BaseDataGenerator datagen: generator with loaded files
+        :param str type: one of [train,val,test]
+        :param tuple target_size:
+        :param int max_samples: samples in one chunk (bounds memory of loaded frames and flows)
+        :param list samples: items to build (e.g. shard of the split), all of the split by default
+        """
+        self.datagen = datagen
+        self.type = type
+        self.target_size = target_size
+        # frames are loaded larger if they are cropped
+        self.load_size = datagen._load_size(type, target_size)
+        self.clips = self.group(datagen._data[type] if samples is None else samples, datagen._clip_key, max_samples)
+
+        n_frames = sum(len(set(path for sample in clip for path in self.frames(sample))) for clip in self.clips)
+        print("-- ClipLoader: %s %d samples in %d chunks, %d frames" % (type, sum(len(clip) for clip in self.clips), len(self.clips), n_frames))
+
+    @staticmethod
+    def frames(sample):
+        """
+        :return list: frame paths of the sample (oldest first)
+        """
+        img = sample[0]
+        return [img] if isinstance(img, str) else list(img)
+
+    @staticmethod
+    def group(samples, clip_key, max_samples):
+        """
+        :param list samples: items of the split
+        :param callable clip_key: clip of the sample
+        :param int max_samples: maximal length of a chunk
+        :return list: chunks (lists of samples ordered by their newest frame)
+        """
+        clips = OrderedDict()
+        for sample in samples:
+            clips.setdefault(clip_key(sample), []).append(sample)
+
+        chunks = []
+        for clip in clips.values():
+            clip = sorted(clip, key=lambda sample: ClipLoader.frames(sample)[-1])
+            chunks.extend(clip[i:i + max_samples] for i in range(0, len(clip), max_samples))
+        return chunks
+
+    def load(self, clip):
+        """
+        Loads frames of the chunk and flows of its samples
+        :param list clip: chunk of samples
+        :return tuple(dict, dict): frames by path, flows by label path
+        """
+        frames = OrderedDict()
+        for sample in clip:
+            for path in self.frames(sample):
+                if path not in frames:
+                    frames[path] = self.datagen._load_resized(self.type, path, self.load_size)
+
+        flows = {}
+        if hasattr(self.datagen, 'calc_optical_flow'):
+            grays = {}
+            pair_flows = {}
+            for sample in clip:
+                old, new = self.frames(sample)[-2:]
+                if (old, new) not in pair_flows:
+                    for path in (old, new):
+                        if path not in grays:
+                            grays[path] = self.datagen.to_gray(frames[path])
+                    # reverse flow, the same as generators compute
+                    pair_flows[old, new] = self.datagen.calc_gray_flow(grays[new], grays[old])
+                flows[sample[1]] = pair_flows[old, new]
+
+        return frames, flows
+
+    def epoch(self, order, shuffle=False):
+        """
+        Builds samples of the chunks
+        :param list order: indices of chunks
+        :param bool shuffle: shuffle samples within chunk
+        :return: iterator of (inputs, outputs)
+        """
+        for i in order:
+            clip = list(self.clips[i])
+            if shuffle:
+                random.shuffle(clip)
+
+            frames, flows = self.load(clip)
+            with self.datagen.clip_context(self.type, self.load_size, frames, flows):
+                for sample in clip:
+                    yield self.datagen._make_sample(self.type, sample, self.target_size)
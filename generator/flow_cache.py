@@ -0,0 +1,177 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+
+class FlowCache:
+    """
+    On-disk cache of optical flow addressed by content of the frame pair.
+
+    The key is a hash of both grayscale frames (so also of their size) and of the flow algorithm with its
+    parameters, so any generator, crop or resolution computing the same flow shares the entry and a changed
+    frame or algorithm never hits a stale one. Flows are stored as float16 `.npy` files (half of float32,
+    error well below 0.1 px), written to a temporary file and renamed, so concurrent readers never see
+    a partial file. When the total size exceeds the budget, least recently used files are removed.
+
+    Files on disk are listed only when they are needed (by the first write under a budget, `trim` or stats),
+    so processes which only read never walk the cache. More processes writing into one cache share the budget
+    through the disk: every process rescans it after writing 5% of the budget and before evicting, so the cache
+    overshoots by at most about 5% of the budget per writing process.
+    """
+
+    version = 1
+
+    def __init__(self, root, max_bytes=None):
+        """
+        :param str root: directory of the cache
+        :param int max_bytes: budget of all cached flows (None = unlimited)
+        """
+        self.root = root
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # path -> [size, last access] of all cached files (also of other processes at the time of the last scan)
+        self._files = None
+        self.bytes = 0
+        # bytes written by this process since the last scan
+        self._written = 0
+
+        if not os.path.isdir(root):
+            os.makedirs(root)
+
+    def _scan(self):
+        self._files = {}
+        self.bytes = 0
+        self._written = 0
+        for dir_path, _, file_names in os.walk(self.root):
+            for name in file_names:
+                if not name.endswith('.npy'):
+                    continue
+                path = os.path.join(dir_path, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                self._files[path] = [stat.st_size, stat.st_mtime]
+                self.bytes += stat.st_size
+
+    def key(self, old_gray, new_gray, params):
+        """
+        :param np.ndarray old_gray: first frame of the flow
+        :param np.ndarray new_gray: second frame of the flow
+        :param dict params: flow algorithm and its parameters
+        :return str:
+        """
+        h = hashlib.sha1(json.dumps({'version': self.version, 'params': params}, sort_keys=True).encode('utf-8'))
+        for gray in (old_gray, new_gray):
+            h.update(str(gray.shape).encode('utf-8'))
+            h.update(np.ascontiguousarray(gray).data)
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.root, key[:2], key + '.npy')
+
+    def get(self, key):
+        """
+        :param str key:
+        :return: float32 flow or None
+        """
+        path = self._path(key)
+        try:
+            flow = np.load(path)
+        except (IOError, OSError, ValueError):
+            with self._lock:
+                self.misses += 1
+            return None
+
+        now = time.time()
+        with self._lock:
+            self.hits += 1
+            entry = self._files.get(path) if self._files is not None else None
+            if entry is not None:
+                entry[1] = now
+        try:
+            # recency is kept on disk for other processes and next runs
+            os.utime(path, (now, now))
+        except OSError:
+            pass
+        return flow.astype(np.float32)
+
+    def put(self, key, flow):
+        """
+        :param str key:
+        :param np.ndarray flow:
+        :return: the flow
+        """
+        path = self._path(key)
+        tmp_path = '%s.tmp%d_%d' % (path, os.getpid(), threading.current_thread().ident)
+        try:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+
+            with open(tmp_path, 'wb') as fp:
+                np.save(fp, flow.astype(np.float16))
+            os.rename(tmp_path, path)
+            size = os.path.getsize(path)
+        except (IOError, OSError) as e:
+            print("-- FlowCache: can't write %s: %s" % (path, e))
+            return flow
+
+        with self._lock:
+            if self._files is None:
+                if self.max_bytes is None:
+                    # unlimited cache doesn't need to know its files
+                    return flow
+                self._scan()
+
+            old = self._files.get(path)
+            if old is not None:
+                self.bytes -= old[0]
+            self._files[path] = [size, time.time()]
+            self.bytes += size
+            self._written += size
+
+            if self.max_bytes is not None:
+                if self.bytes > self.max_bytes or self._written > 0.05 * self.max_bytes:
+                    # other processes may write into the cache too
+                    self._scan()
+                if self.bytes > self.max_bytes:
+                    self._evict()
+        return flow
+
+    def trim(self):
+        """
+        Lists the cache on disk and removes least recently used files over the budget
+        """
+        with self._lock:
+            self._scan()
+            if self.max_bytes is not None and self.bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        # removes least recently used files down to 90% of the budget, so eviction doesn't run on every put
+        for path, (size, _) in sorted(self._files.items(), key=lambda item: item[1][1]):
+            if self.bytes <= 0.9 * self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            del self._files[path]
+            self.bytes -= size
+
+    def __len__(self):
+        with self._lock:
+            if self._files is None:
+                self._scan()
+            return len(self._files)
+
+    def __str__(self):
+        requests = self.hits + self.misses
+        return "FlowCache: %d flows, %.1f MB, hit rate %.1f%% (%d/%d)" % (
+            len(self), self.bytes / 2. ** 20, 100. * self.hits / max(requests, 1), self.hits, requests)
@@ -0,0 +1,49 @@
+import numpy as np
+
+
+class FlowStream:
+    """
+    Optical flow of consecutive frames of one video (or frame sequence).
+
+    Keeps grayscale version of the last frame, so every frame is converted once, and with DIS the last flow,
+    which seeds the next computation (passed to `calc` as initial). Farneback and DeepFlow always start from zero,
+    the same as the flows the models are trained on. The stream has its own instance of the flow algorithm.
+    Flow is reverse (from the pushed frame to the previous one), the same as generators compute,
+    and is computed at the flow scale of the generator. Flows are not cached, they depend on the history.
+    """
+
+    def __init__(self, datagen, warm_start=True):
+        """
+        :param BaseFlowGenerator datagen: generator with the flow settings
+        :param bool warm_start: seed the flow with the previous one (DIS only)
+        """
+        self.datagen = datagen
+        self.warm_start = warm_start and datagen.optical_flow_type == 'dis'
+        self.optical_flow = datagen.create_optical_flow()
+        self.reset()
+
+    def reset(self):
+        """
+        Starts a new stream (e.g. after a cut or with other video)
+        """
+        self._prev_gray = None
+        self._flow = None
+
+    def push(self, frame):
+        """
+        :param np.ndarray frame: next frame (BGR)
+        :return np.ndarray: flow from the frame to the previous one (zeros for the first frame)
+        """
+        gray = self.datagen._reduce_gray(self.datagen.to_gray(frame))
+
+        if self._prev_gray is None or self._prev_gray.shape != gray.shape:
+            flow = np.zeros(gray.shape + (2,), dtype=np.float32)
+            self._flow = None
+        else:
+            # the last flow is the initial estimate, the algorithm writes the result into it
+            initial = self._flow.copy() if self.warm_start and self._flow is not None else None
+            flow = self.datagen._compute_gray_flow(gray, self._prev_gray, self.optical_flow, initial)
+            self._flow = flow
+
+        self._prev_gray = gray
+        return self.datagen._expand_flow(flow, frame.shape[:2])
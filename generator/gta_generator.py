@@ -15,37 +15,42 @@ class GTAGenerator(BaseDataGenerator):
             'n_classes': len(labels)
         }
 
-    def __init__(self, dataset_path, debug_samples=0):
+    def __init__(self, dataset_path, debug_samples=0, sparse_labels=False):
         dataset_path = os.path.join(dataset_path, 'gta/')
-        super(GTAGenerator, self).__init__(dataset_path, debug_samples)
+        super(GTAGenerator, self).__init__(dataset_path, debug_samples, sparse_labels=sparse_labels)
 
     @property
     def name(self):
         return 'gta'
 
+    _split_path = os.path.join('./generator/gta_read_mapping', 'split.mat')
+
+    # Files with different size in img and mask
+    _to_remove = set([1, 2, 15188] + list(range(20803, 20835)) + list(range(20858, 20861)))
+
     def _fill_split(self, which_set):
-        split = self._get_filenames(which_set)
+        # split.mat is loaded only when it changed since the index was saved
+        index = self._sample_index(which_set)
+        samples = index.samples('split', [self._split_path], lambda: self._scan_split(which_set))
+        index.save()
 
-        for img_id in split:
-            img_path = os.path.join(self.dataset_path, 'images/', img_id)
-            lab_path = os.path.join(self.dataset_path, 'labels/', img_id)
-            self._data[which_set].append((img_path, lab_path))
+        self._data[which_set] = list(samples)
+
+    def _scan_split(self, which_set):
+        return [
+            (os.path.join(self.dataset_path, 'images/', img_id), os.path.join(self.dataset_path, 'labels/', img_id))
+            for img_id in self._get_filenames(which_set)
+        ]
 
     def _get_filenames(self, which_set):
         """Get file names for this set."""
 
         import scipy.io
 
-        filenames = []
-        split = scipy.io.loadmat(os.path.join('./generator/gta_read_mapping', 'split.mat'))
+        split = scipy.io.loadmat(self._split_path)
         split = split[which_set + "Ids"]
 
-        # To remove (Files with different size in img and mask)
-        to_remove = [1, 2] + [15188, ] + range(20803, 20835) + range(20858, 20861)
-
-        for id in split:
-            if id not in to_remove:
-                filenames.append(str(id[0]).zfill(5) + '.png')
+        filenames = [str(id[0]).zfill(5) + '.png' for id in split if int(id[0]) not in self._to_remove]
 
         print('GTA5: ' + which_set + ' ' + str(len(filenames)) + ' files')
         return filenames
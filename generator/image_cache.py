@@ -0,0 +1,76 @@
+import threading
+from collections import OrderedDict
+
+
+class ImageCache:
+    """
+    In-process LRU cache of decoded and resized images bounded by byte budget.
+
+    Stored images are marked read-only, augmentations always create new arrays.
+    """
+
+    def __init__(self, max_bytes):
+        """
+        :param int max_bytes: budget for all cached images
+        """
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        :param key: e.g. (path, target_size)
+        :return: cached image or None
+        """
+        with self._lock:
+            img = self._items.pop(key, None)
+            if img is None:
+                self.misses += 1
+                return None
+
+            # most recently used goes to the end
+            self._items[key] = img
+            self.hits += 1
+            return img
+
+    def put(self, key, img):
+        if img.nbytes > self.max_bytes:
+            return img
+
+        img.flags.writeable = False
+
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self.bytes -= old.nbytes
+
+            self._items[key] = img
+            self.bytes += img.nbytes
+
+            while self.bytes > self.max_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self.bytes -= evicted.nbytes
+
+        return img
+
+    def __len__(self):
+        return len(self._items)
+
+    def stats(self):
+        """
+        :rtype: dict
+        """
+        requests = self.hits + self.misses
+        return {
+            'items': len(self._items),
+            'mb': self.bytes / 2. ** 20,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / float(requests) if requests else 0.,
+        }
+
+    def __str__(self):
+        return "ImageCache: %(items)d images, %(mb).1f MB, hits %(hits)d, misses %(misses)d (hit rate %(hit_rate).2f)" % self.stats()
@@ -0,0 +1,116 @@
+import cv2
+import numpy as np
+
+
+class LabelEncoder:
+    """
+    Encodes label images into class indices with one precomputed lookup table.
+
+    Label images are either single channel ids (Cityscapes labelIds) or colors (CamVid, GTA). Colors are packed
+    into one 24-bit key, so both formats are mapped to class index by a single gather per pixel.
+    Pixels which don't belong to any label get index `n_classes`, the ignore index of sparse labels
+    (all zeros in one-hot).
+    """
+
+    def __init__(self, table, n_classes, is_color):
+        """
+        :param np.ndarray table: lookup table from key (id or packed color) to class index
+        :param int n_classes:
+        :param bool is_color: if keys are packed RGB colors
+        """
+        self.n_classes = n_classes
+        self.is_color = is_color
+        self._table = table
+        # last row is for unknown pixels
+        self._eye = np.eye(n_classes + 1, n_classes, dtype=np.uint8)
+
+    def void_index(self):
+        """
+        :return int: class index of pixels without label (ignored by loss and metrics)
+        """
+        return self.n_classes
+
+    @classmethod
+    def from_ids(cls, ids):
+        """
+        :param list ids: label id for each class (negative ids are never matched)
+        :rtype: LabelEncoder
+        """
+        n_classes = len(ids)
+        table = np.full(256, n_classes, dtype=np.uint8)
+        # first label wins if more of them share the same id
+        for class_id, lab_id in reversed(list(enumerate(ids))):
+            if 0 <= lab_id < 256:
+                table[lab_id] = class_id
+        return cls(table, n_classes, is_color=False)
+
+    @classmethod
+    def from_colors(cls, colors):
+        """
+        :param list colors: RGB color for each class
+        :rtype: LabelEncoder
+        """
+        n_classes = len(colors)
+        table = np.full(1 << 24, n_classes, dtype=np.uint8)
+        # first label wins if more of them share the same color
+        for class_id, (r, g, b) in reversed(list(enumerate(colors))):
+            table[(r << 16) | (g << 8) | b] = class_id
+        return cls(table, n_classes, is_color=True)
+
+    @staticmethod
+    def pack_bgr(img):
+        """
+        Packs BGR image (as loaded by OpenCV) into 24-bit RGB keys
+        :param np.ndarray img: uint8 image (height, width, 3)
+        :rtype: np.ndarray
+        """
+        key = img[..., 2].astype(np.uint32)
+        key <<= 8
+        key |= img[..., 1]
+        key <<= 8
+        key |= img[..., 0]
+        return key
+
+    def encode(self, label_img, target_size=None):
+        """
+        :param np.ndarray label_img: BGR color image or ids (single or 3 channel)
+        :param tuple target_size: (height, width) or None to keep size
+        :return: uint8 class indices (height, width)
+        """
+        if not self.is_color and label_img.ndim == 3:
+            label_img = label_img[..., 0]
+
+        if target_size is not None and label_img.shape[:2] != tuple(target_size):
+            height, width = label_img.shape[:2]
+            if height % target_size[0] == 0 and width % target_size[1] == 0:
+                # integer downscale, strided view picks the same pixels as nearest resize
+                label_img = label_img[::height // target_size[0], ::width // target_size[1]]
+            else:
+                label_img = cv2.resize(label_img, target_size[::-1], interpolation=cv2.INTER_NEAREST)
+
+        key = self.pack_bgr(label_img) if self.is_color else label_img
+        return np.take(self._table, key)
+
+    @staticmethod
+    def pyramid(indices, sizes):
+        """
+        Class indices in more (smaller) sizes, each level is nearest-downsampled from the finer one
+        :param np.ndarray indices: class indices of the finest level
+        :param list sizes: (height, width) of each level
+        :return list: class indices in the order of sizes
+        """
+        levels = {}
+        level = indices
+        for size in sorted(set(tuple(size) for size in sizes), reverse=True):
+            if level.shape[:2] != size:
+                level = cv2.resize(level, size[::-1], interpolation=cv2.INTER_NEAREST)
+            levels[size] = level
+        return [levels[tuple(size)] for size in sizes]
+
+    def one_hot(self, indices, out=None):
+        """
+        :param np.ndarray indices: class indices (height, width)
+        :param np.ndarray out: optional uint8 output (height, width, n_classes)
+        :return: uint8 one-hot tensor (height, width, n_classes)
+        """
+        return np.take(self._eye, indices, axis=0, out=out)
@@ -0,0 +1,58 @@
+import cv2
+import numpy as np
+
+
+class Normalizer:
+    """
+    Fused resize and normalization of uint8 frames.
+
+    Min-max normalization to [0, 1] followed by standardization with per-channel mean and std depends only
+    on the pixel value, so it is precomputed into a 256 entry table for every channel and applied in one
+    pass straight into the output buffer.
+    """
+
+    def __init__(self, mean=(0., 0., 0.), std=(1., 1., 1.), dtype=np.float32):
+        """
+        :param tuple mean: per-channel mean (of the [0, 1] image)
+        :param tuple std: per-channel std
+        :param dtype: np.float32 or np.float16
+        """
+        self.mean = np.array(mean, dtype=np.float64)
+        self.std = np.array(std, dtype=np.float64)
+        self.dtype = np.dtype(dtype)
+        self._values = np.arange(256, dtype=np.float64)
+        self._channels = np.arange(len(mean))
+
+    def table(self, img):
+        """
+        :param np.ndarray img: uint8 image (the table depends on its min and max, as `cv2.NORM_MINMAX`)
+        :return: table (256, channels)
+        """
+        min_val, max_val, _, _ = cv2.minMaxLoc(img.reshape(-1))
+        if max_val > min_val:
+            scaled = (self._values - min_val) / (max_val - min_val)
+        else:
+            scaled = np.zeros_like(self._values)
+
+        return ((scaled[:, np.newaxis] - self.mean) / self.std).astype(self.dtype)
+
+    def __call__(self, img, target_size=None, out=None):
+        """
+        :param np.ndarray img: uint8 image (height, width, channels)
+        :param tuple target_size: (height, width) or None to keep size
+        :param np.ndarray out: output buffer of target size and normalizer dtype (allocated if None)
+        :return: normalized image
+        """
+        if target_size is not None and img.shape[:2] != tuple(target_size):
+            img = cv2.resize(img, target_size[::-1])
+
+        table = self.table(img)
+
+        if out is None:
+            out = np.empty(img.shape, dtype=self.dtype)
+
+        if self.dtype == np.float32:
+            cv2.LUT(img, table.reshape(1, 256, -1), dst=out)
+        else:
+            out[...] = table[img, self._channels]
+        return out
@@ -0,0 +1,95 @@
+import hashlib
+import json
+import os
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+
+class SampleIndex:
+    """
+    On-disk index of samples (file paths) of one dataset split.
+
+    Samples are listed per unit (e.g. city directory) and every unit is validated by modification times of
+    the paths it depends on, so only units whose directories changed are rescanned. The index file is keyed
+    by dataset, split and parameters of the generator (how_many_prev, prev_skip, ...).
+    """
+
+    version = 1
+
+    def __init__(self, root, dataset, split, **params):
+        """
+        :param str root: directory of all indexes
+        :param str dataset: dataset path
+        :param str split: one of [train,val,test]
+        :param params: generator parameters which change the samples
+        """
+        self.key = {
+            'version': self.version,
+            'dataset': dataset,
+            'split': split,
+            'params': params,
+        }
+        key_hash = hashlib.md5(json.dumps(self.key, sort_keys=True).encode('utf-8')).hexdigest()[:10]
+        self.path = os.path.join(root, '%s_%s.pkl' % (split, key_hash))
+
+        self.rescanned = 0
+        self._units = self._read()
+        self._used = {}
+
+    def _read(self):
+        try:
+            with open(self.path, 'rb') as fp:
+                index = pickle.load(fp)
+        except (IOError, OSError, EOFError, ValueError, pickle.UnpicklingError):
+            return {}
+
+        return index['units'] if index.get('key') == self.key else {}
+
+    @staticmethod
+    def _mtime(path):
+        try:
+            return os.stat(path).st_mtime
+        except OSError:
+            return None
+
+    def samples(self, name, deps, scan):
+        """
+        :param str name: unit of the split
+        :param list deps: paths (directories or files) the unit is listed from
+        :param callable scan: lists samples of the unit, called only if some of deps changed
+        :return list: samples of the unit
+        """
+        mtimes = {path: self._mtime(path) for path in deps}
+
+        unit = self._units.get(name)
+        if unit is None or unit[0] != mtimes:
+            unit = (mtimes, scan())
+            self.rescanned += 1
+
+        self._used[name] = unit
+        return unit[1]
+
+    def save(self):
+        """
+        Writes units used since opening (units not listed anymore are dropped)
+        """
+        if not self.rescanned and len(self._used) == len(self._units):
+            return
+
+        tmp_path = '%s.tmp%d' % (self.path, os.getpid())
+        try:
+            if not os.path.isdir(os.path.dirname(self.path)):
+                os.makedirs(os.path.dirname(self.path))
+
+            with open(tmp_path, 'wb') as fp:
+                pickle.dump({'key': self.key, 'units': self._used}, fp, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError) as e:
+            print("-- SampleIndex: can't write %s: %s" % (self.path, e))
+            return
+
+        self._units = dict(self._used)
+        print("-- SampleIndex: %d of %d units rescanned, saved %s" % (self.rescanned, len(self._used), self.path))
@@ -0,0 +1,142 @@
+import threading
+from collections import deque
+
+import numpy as np
+
+
+class ShardSampler:
+    """
+    Deterministic order of samples of one shard (rank) of a dataset split.
+
+    Every epoch all ranks draw the same permutation (seeded by seed + epoch) and take every `world_size`-th
+    sample of it starting at `rank`, so shards are disjoint. The permutation is padded by its own beginning
+    to a multiple of world_size, so all shards have equal length.
+    """
+
+    def __init__(self, n_samples, rank=0, world_size=1, seed=2018, shuffle=True):
+        """
+        :param int n_samples: length of the split
+        :param int rank: index of this shard
+        :param int world_size: number of shards (training processes)
+        :param int seed: seed of the shuffling, must be the same for all ranks
+        :param bool shuffle: reshuffle every epoch (otherwise samples keep their order)
+        """
+        if not 0 <= rank < world_size:
+            raise Exception('Rank %d is out of world size %d!' % (rank, world_size))
+
+        self.n_samples = n_samples
+        self.rank = rank
+        self.world_size = world_size
+        self.seed = seed
+        self.shuffle = shuffle
+
+    def __len__(self):
+        return -(-self.n_samples // self.world_size)
+
+    def indices(self, epoch=0):
+        """
+        :param int epoch:
+        :return np.ndarray: indices of samples of this shard in the epoch
+        """
+        if self.shuffle:
+            order = np.random.RandomState(self.seed + epoch).permutation(self.n_samples)
+        else:
+            order = np.arange(self.n_samples)
+
+        # repeats the order cyclically up to the padded length
+        order = np.resize(order, len(self) * self.world_size)
+        return order[self.rank::self.world_size]
+
+    def drawn(self, indices):
+        """
+        Called with samples of every yielded batch (for samplers learning from training)
+        """
+        pass
+
+    def epochs(self, first_epoch=0):
+        """
+        Endless iterator over indices, epoch after epoch
+        """
+        epoch = first_epoch
+        while True:
+            for i in self.indices(epoch):
+                yield i
+            epoch += 1
+
+
+class ImportanceSampler(ShardSampler):
+    """
+    Draws samples of the shard with probability proportional to their recent training loss.
+
+    Losses are fed back per batch (`drawn` remembers samples of every yielded batch in order, `record` assigns
+    the loss of the oldest not yet recorded batch to its samples), so the generator must yield batches in order
+    they are trained on. A share of every draw stays uniform, so easy samples are still visited.
+    Samples without recorded loss get the highest known loss.
+    """
+
+    def __init__(self, n_samples, rank=0, world_size=1, seed=2018, uniform=0.3, smoothing=0.5):
+        """
+        :param int n_samples: length of the split
+        :param int rank: index of this shard
+        :param int world_size: number of shards
+        :param int seed: seed of drawing (combined with epoch)
+        :param float uniform: floor of uniform sampling (0 = losses only, 1 = uniform)
+        :param float smoothing: weight of the older loss in exponential moving average
+        """
+        ShardSampler.__init__(self, n_samples, rank, world_size, seed, shuffle=False)
+        self.uniform = uniform
+        self.smoothing = smoothing
+        self.losses = np.full(n_samples, np.nan)
+        self.coverage = 0.
+        self.effective_size = 0.
+        self._pending = deque()
+        self._lock = threading.Lock()
+
+    def probabilities(self, members):
+        """
+        :param np.ndarray members: indices of samples of the shard
+        :return np.ndarray: probability of drawing each member
+        """
+        losses = self.losses[members]
+        known = ~np.isnan(losses)
+        if not known.any():
+            return np.full(len(members), 1. / len(members))
+
+        losses = np.where(known, losses, losses[known].max())
+        weights = losses / losses.sum() if losses.sum() > 0 else np.full(len(members), 1. / len(members))
+        return (1. - self.uniform) * weights + self.uniform / len(members)
+
+    def indices(self, epoch=0):
+        members = ShardSampler.indices(self, epoch)
+        if len(members) == 0:
+            return members
+
+        probabilities = self.probabilities(members)
+        drawn = np.random.RandomState(self.seed + epoch).choice(members, size=len(members), p=probabilities)
+
+        self.coverage = len(np.unique(drawn)) / float(len(np.unique(members)))
+        self.effective_size = 1. / np.sum(probabilities ** 2) / len(members)
+        return drawn
+
+    def drawn(self, indices):
+        """
+        :param list indices: samples of a batch yielded to the training
+        """
+        with self._lock:
+            self._pending.append(np.asarray(indices))
+
+    def record(self, loss):
+        """
+        :param float loss: training loss of the oldest pending batch
+        """
+        with self._lock:
+            if not self._pending:
+                return
+            indices = self._pending.popleft()
+
+        old = self.losses[indices]
+        self.losses[indices] = np.where(np.isnan(old), loss, self.smoothing * old + (1. - self.smoothing) * loss)
+
+    def __str__(self):
+        return "ImportanceSampler: coverage %.2f, effective size %.2f, losses known for %d/%d samples" % (
+            self.coverage, self.effective_size, np.count_nonzero(~np.isnan(self.losses)), self.n_samples)
@@ -0,0 +1,153 @@
+import hashlib
+import os
+import shutil
+import threading
+
+try:
+    from Queue import Queue, Empty
+except ImportError:
+    from queue import Queue, Empty
+
+
+class ScratchStager:
+    """
+    Copies dataset files to local scratch directory in background threads.
+
+    Files keep their path relative to the dataset (other files get hashed directory), so equal file names
+    from different cities or splits don't collide. Every file is copied under temporary name and renamed
+    when complete, so a file found in scratch is always whole. Until then, readers use the original path.
+    Copying threads can be stopped (e.g. while the process forks) and started again, scheduled files are kept.
+    """
+
+    def __init__(self, scratch_dir, source_root, workers=2, report_every=500):
+        """
+        :param str scratch_dir: local directory (e.g. $SCRATCH)
+        :param str source_root: dataset directory, paths below it are preserved in scratch
+        :param int workers: copying threads
+        :param int report_every: print progress after every n staged files
+        """
+        self.scratch_dir = scratch_dir
+        self.source_root = os.path.abspath(source_root)
+        self.report_every = report_every
+        self.staged = 0
+        self.failed = 0
+        self.total = 0
+        self.workers = workers
+        # forked processes only look files up, copying is left to the parent
+        self.readonly = False
+        self._scheduled = set()
+        self._lock = threading.Lock()
+        self._queue = Queue()
+        self._stopping = threading.Event()
+        self._threads = []
+
+        self.start()
+        print("-- staging files from %s to %s" % (self.source_root, self.scratch_dir))
+
+    def start(self):
+        """
+        Starts copying threads (if they are not running)
+        """
+        if self._threads:
+            return
+
+        self._stopping.clear()
+        for _ in range(self.workers):
+            thread = threading.Thread(target=self._worker_loop)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        """
+        Stops copying threads after their current file, files waiting for copying stay scheduled
+        """
+        self._stopping.set()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def staged_path(self, path):
+        """
+        :param str path: original path
+        :return str: path in scratch directory
+        """
+        path = os.path.abspath(path)
+        rel_path = os.path.relpath(path, self.source_root)
+        if rel_path.startswith(os.pardir):
+            # outside of dataset, directory is hashed
+            dir_hash = hashlib.md5(os.path.dirname(path).encode('utf-8')).hexdigest()[:12]
+            rel_path = os.path.join('_other', dir_hash, os.path.basename(path))
+        return os.path.join(self.scratch_dir, rel_path)
+
+    def stage(self, paths):
+        """
+        Schedules files for copying (in given order)
+        :param list paths:
+        """
+        if self.readonly:
+            return
+
+        with self._lock:
+            for path in paths:
+                if path not in self._scheduled:
+                    self._scheduled.add(path)
+                    self.total += 1
+                    self._queue.put(path)
+
+    def lookup(self, path):
+        """
+        :param str path: original path
+        :return str: staged path if file is completely copied, original path otherwise (file gets scheduled)
+        """
+        staged = self.staged_path(path)
+        if os.path.exists(staged):
+            return staged
+
+        self.stage([path])
+        return path
+
+    def progress(self):
+        """
+        :return tuple(int, int): staged files, scheduled files
+        """
+        return self.staged, self.total
+
+    def _copy(self, path):
+        staged = self.staged_path(path)
+        if os.path.exists(staged):
+            return
+
+        staged_dir = os.path.dirname(staged)
+        try:
+            os.makedirs(staged_dir)
+        except OSError:
+            if not os.path.isdir(staged_dir):
+                raise
+
+        tmp = '%s.part%d.%d' % (staged, os.getpid(), threading.current_thread().ident)
+        shutil.copyfile(path, tmp)
+        # rename is atomic, readers never see partially copied file
+        os.rename(tmp, staged)
+
+    def _worker_loop(self):
+        while not self._stopping.is_set():
+            try:
+                path = self._queue.get(timeout=0.5)
+            except Empty:
+                continue
+
+            try:
+                self._copy(path)
+            except (IOError, OSError) as e:
+                print("--- staging of %s failed: %s" % (path, e))
+                with self._lock:
+                    self.failed += 1
+                continue
+
+            with self._lock:
+                self.staged += 1
+                staged = self.staged
+
+            if staged % self.report_every == 0 or staged == self.total:
+                print("-- staged %d/%d files to scratch (%d failed)" % (staged, self.total, self.failed))
@@ -0,0 +1,63 @@
+import random
+
+import numpy as np
+from keras.utils import Sequence
+
+
+class DataSequence(Sequence):
+    """
+    Index-addressable counterpart of `BaseDataGenerator.flow` for any dataset generator.
+
+    Batch `idx` always contains the same samples within an epoch, so Keras workers (threads or processes)
+    can build batches in parallel without duplicates. Order of samples is reshuffled after every epoch,
+    only samples of the shard of datagen are used (see `BaseDataGenerator.shard`).
+    Both the order and the random augmentations of a batch are derived from the epoch (carried by the sequence
+    Keras hands to its workers) and the batch index, never from random state of the worker, which forked
+    workers inherit all the same.
+    """
+
+    def __init__(self, datagen, type, batch_size, target_size, shuffle=True):
+        """
+        :param BaseDataGenerator datagen: generator with loaded files
+        :param str type: one of [train,val,test]
+        :param int batch_size:
+        :param tuple target_size:
+        :param bool shuffle: reshuffle samples on epoch end
+        """
+        if not datagen._files_loaded:
+            raise Exception('Files weren\'t loaded first!')
+
+        self.datagen = datagen
+        self.type = type
+        self.batch_size = batch_size
+        self.target_size = target_size
+        self.shuffle = shuffle
+        self.epoch = 0
+        self._sampler = datagen.sampler(type, shuffle)
+        self._order = None
+        self._order_epoch = None
+
+    def __len__(self):
+        return self.datagen.steps_per_epoch(self.type, self.batch_size)
+
+    def _epoch_order(self, epoch):
+        if self._order_epoch != epoch:
+            self._order = self._sampler.indices(epoch)
+            self._order_epoch = epoch
+        return self._order
+
+    def _seed_batch(self, epoch, idx):
+        seed = np.random.RandomState([self._sampler.seed, epoch, self.datagen.rank, idx]).randint(2 ** 31)
+        random.seed(seed)
+        np.random.seed(seed)
+
+    def __getitem__(self, idx):
+        epoch = self.epoch
+        data = self.datagen._data[self.type]
+        indices = self._epoch_order(epoch)[idx * self.batch_size:(idx + 1) * self.batch_size]
+        self._seed_batch(epoch, idx)
+        samples = [self.datagen._make_sample(self.type, data[i], self.target_size) for i in indices]
+        return self.datagen._collate(samples)
+
+    def on_epoch_end(self):
+        self.epoch += 1
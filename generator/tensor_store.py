@@ -0,0 +1,231 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+
+
+class TensorStore:
+    """
+    Preprocessed samples of one dataset split in memory-mapped arrays.
+
+    Holds images resized to target size (uint8), label class indices for every label scale
+    (e.g. 1/4, 1/8 and 1/16 for ICNet) and optionally optical flow of each sample. Generators read
+    rows from it instead of decoding and resizing the original PNGs. The manifest is keyed by dataset, split,
+    target size and label mode, and carries fingerprint of the source files, so the store is rebuilt
+    whenever sources or parameters change.
+    """
+
+    version = 3
+    manifest_name = 'manifest.json'
+
+    def __init__(self, root, dataset, split, target_size, label_mode, label_subs=(1,), flow_type=None):
+        """
+        :param str root: directory of all stores
+        :param str dataset: name of the dataset
+        :param str split: one of [train,val,test]
+        :param tuple target_size: (height, width)
+        :param str label_mode: 'sparse' | 'one_hot'
+        :param tuple label_subs: label scales, label size is target_size // sub
+        :param str flow_type: optical flow type to store or None without flow
+        """
+        self.target_size = tuple(target_size)
+        self.label_subs = tuple(label_subs)
+        self.key = {
+            'version': self.version,
+            'dataset': dataset,
+            'split': split,
+            'target_size': list(self.target_size),
+            'label_mode': label_mode,
+            'label_subs': list(self.label_subs),
+            'flow_type': flow_type,
+        }
+        key_hash = hashlib.md5(json.dumps(self.key, sort_keys=True).encode('utf-8')).hexdigest()[:10]
+        self.path = os.path.join(root, dataset, split, '%dx%d_%s_%s' % (target_size[0], target_size[1], label_mode, key_hash))
+
+        self._images = None
+        self._labels = None
+        self._flows = None
+        self._image_rows = {}
+        self._label_rows = {}
+        self._flow_rows = {}
+
+    @staticmethod
+    def split_paths(samples):
+        """
+        :param list samples: items of the split ((image path or list of paths), label path)
+        :return tuple(list, list): unique image paths, label paths
+        """
+        images = []
+        seen = set()
+        for img, _ in samples:
+            for path in ([img] if isinstance(img, str) else img):
+                if path not in seen:
+                    seen.add(path)
+                    images.append(path)
+
+        return images, [label for _, label in samples]
+
+    @staticmethod
+    def fingerprint(paths):
+        """
+        Fingerprint of source files (path, size and modification time)
+        :param list paths:
+        :rtype: str
+        """
+        md5 = hashlib.md5()
+        for path in sorted(paths):
+            try:
+                stat = os.stat(path)
+                md5.update(('%s:%d:%d\n' % (path, stat.st_size, int(stat.st_mtime))).encode('utf-8'))
+            except OSError:
+                md5.update(('%s:missing\n' % path).encode('utf-8'))
+        return md5.hexdigest()
+
+    def _read_manifest(self):
+        try:
+            with open(os.path.join(self.path, self.manifest_name), 'r') as fp:
+                return json.load(fp)
+        except (IOError, ValueError):
+            return None
+
+    def is_valid(self, samples):
+        """
+        :param list samples: items of the split
+        :return bool: if store exists and was built from the same files and parameters
+        """
+        manifest = self._read_manifest()
+        if manifest is None or manifest['key'] != self.key:
+            return False
+
+        # rows are looked up by path, so the store serves the split in any (e.g. reshuffled) order
+        images, labels = self.split_paths(samples)
+        return sorted(manifest['images']) == sorted(images) \
+            and sorted(manifest['labels']) == sorted(labels) \
+            and manifest['fingerprint'] == self.fingerprint(images + labels)
+
+    def wait(self, samples, timeout=24 * 3600, poll_seconds=10):
+        """
+        Waits until the store is built by another process (e.g. the first training rank)
+        :param list samples: items of the split
+        :param float timeout: seconds to wait at most
+        :param float poll_seconds:
+        """
+        print("-- TensorStore: waiting for %s" % self.path)
+        deadline = time.time() + timeout
+        while not self.is_valid(samples):
+            if time.time() > deadline:
+                raise Exception("TensorStore %s wasn't built in %d s!" % (self.path, timeout))
+            time.sleep(poll_seconds)
+
+    def build(self, datagen, samples):
+        """
+        Preprocesses all samples of the split into memory-mapped arrays
+        :param BaseDataGenerator datagen:
+        :param list samples: items of the split
+        """
+        from utils import print_progress
+
+        images, labels = self.split_paths(samples)
+        with_flow = self.key['flow_type'] is not None
+
+        tmp_path = self.path + '.tmp%d' % os.getpid()
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path)
+
+        print("-- TensorStore: building %s (%d images, %d labels)" % (self.path, len(images), len(labels)))
+
+        images_arr = np.lib.format.open_memmap(
+            os.path.join(tmp_path, 'images.npy'), mode='w+', dtype=np.uint8, shape=(len(images),) + self.target_size + (3,)
+        )
+        for i, path in enumerate(images):
+            images_arr[i] = datagen._load_img_resized(path, self.target_size)
+            print_progress(i + 1, len(images), prefix='images:', bar_length=50)
+        images_arr.flush()
+
+        for sub in self.label_subs:
+            size = tuple(a // sub for a in self.target_size)
+            labels_arr = np.lib.format.open_memmap(
+                os.path.join(tmp_path, 'labels_%d.npy' % sub), mode='w+', dtype=np.uint8, shape=(len(labels),) + size
+            )
+            for i, path in enumerate(labels):
+                label_img = datagen._load_img(path, datagen._label_imread_flags)
+                labels_arr[i] = datagen.label_encoder.encode(label_img, size)
+                print_progress(i + 1, len(labels), prefix='labels 1/%d:' % sub, bar_length=50)
+            labels_arr.flush()
+
+        if with_flow:
+            image_rows = {path: i for i, path in enumerate(images)}
+            flow_arr = np.lib.format.open_memmap(
+                os.path.join(tmp_path, 'flow.npy'), mode='w+', dtype=np.float32, shape=(len(samples),) + self.target_size + (2,)
+            )
+            for i, (img, _) in enumerate(samples):
+                img_old_path, img_new_path = img[-2:]
+                # reverse flow, the same as generators compute
+                flow_arr[i] = datagen.calc_optical_flow(images_arr[image_rows[img_new_path]], images_arr[image_rows[img_old_path]])
+                print_progress(i + 1, len(samples), prefix='flow:', bar_length=50)
+            flow_arr.flush()
+
+        with open(os.path.join(tmp_path, self.manifest_name), 'w') as fp:
+            json.dump({
+                'key': self.key,
+                'fingerprint': self.fingerprint(images + labels),
+                'images': images,
+                'labels': labels,
+            }, fp)
+
+        # replace old store at once
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path)
+        os.rename(tmp_path, self.path)
+
+    def open(self):
+        """
+        Maps arrays of the store into memory
+        :return: self
+        """
+        manifest = self._read_manifest()
+        if manifest is None:
+            raise Exception("TensorStore %s wasn't built!" % self.path)
+
+        self._images = np.load(os.path.join(self.path, 'images.npy'), mmap_mode='r')
+        self._labels = {sub: np.load(os.path.join(self.path, 'labels_%d.npy' % sub), mmap_mode='r') for sub in self.label_subs}
+        if self.key['flow_type'] is not None:
+            self._flows = np.load(os.path.join(self.path, 'flow.npy'), mmap_mode='r')
+
+        self._image_rows = {path: i for i, path in enumerate(manifest['images'])}
+        self._label_rows = {path: i for i, path in enumerate(manifest['labels'])}
+        self._flow_rows = self._label_rows
+        print("-- TensorStore: opened %s" % self.path)
+        return self
+
+    def has_image(self, img_path):
+        return img_path in self._image_rows
+
+    def has_label(self, label_path):
+        return label_path in self._label_rows
+
+    def has_flow(self, label_path):
+        return self._flows is not None and label_path in self._flow_rows
+
+    def image(self, img_path):
+        """
+        :return: uint8 BGR image of target size (read-only)
+        """
+        return self._images[self._image_rows[img_path]]
+
+    def label(self, label_path, sub=1):
+        """
+        :return: uint8 class indices of size target_size // sub (read-only)
+        """
+        return self._labels[sub][self._label_rows[label_path]]
+
+    def flow(self, label_path):
+        """
+        :param label_path: label of the sample
+        :return: reverse optical flow of the sample (read-only)
+        """
+        return self._flows[self._flow_rows[label_path]]
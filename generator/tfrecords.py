@@ -0,0 +1,300 @@
+import json
+import os
+import shutil
+import time
+
+import cv2
+import numpy as np
+import tensorflow as tf
+
+
+def _bytes_feature(value):
+    return tf.train.Feature(bytes_list=tf.train.BytesList(value=[value]))
+
+
+def _int64_feature(value):
+    return tf.train.Feature(int64_list=tf.train.Int64List(value=[value]))
+
+
+def _png(img):
+    ok, encoded = cv2.imencode('.png', img)
+    if not ok:
+        raise Exception('PNG encoding failed!')
+    return encoded.tobytes()
+
+
+# format of records and their manifest, bumped whenever they change
+# (2: unknown pixels keep the ignore index n_classes instead of class 0)
+FORMAT_VERSION = 2
+
+
+def shard_path(out_dir, type, shard, shards):
+    return os.path.join(out_dir, '%s-%05d-of-%05d.tfrecord' % (type, shard, shards))
+
+
+def manifest_path(out_dir, type):
+    return os.path.join(out_dir, '%s.json' % type)
+
+
+def export_params(datagen, target_size, with_flow=None):
+    """
+    Parameters records are exported with, readers need the same ones
+    :param BaseDataGenerator datagen:
+    :param tuple target_size: (height, width)
+    :param bool with_flow: store previous frame and flow (default for flow generators)
+    :rtype: dict
+    """
+    if with_flow is None:
+        with_flow = hasattr(datagen, 'calc_optical_flow')
+
+    return {
+        'version': FORMAT_VERSION,
+        'target_size': list(target_size),
+        'with_flow': with_flow,
+        'flow_type': datagen._stored_flow_type() if with_flow else None,
+        'n_classes': datagen.n_classes,
+    }
+
+
+def read_manifest(out_dir, type):
+    """
+    :return dict: manifest of the exported split or None
+    """
+    try:
+        with open(manifest_path(out_dir, type), 'r') as fp:
+            return json.load(fp)
+    except (IOError, ValueError):
+        return None
+
+
+def is_exported(out_dir, type, params):
+    """
+    :param dict params: from `export_params`
+    :return bool: if the split is exported with the same parameters
+    """
+    manifest = read_manifest(out_dir, type)
+    return manifest is not None and all(manifest.get(name) == value for name, value in params.items())
+
+
+def wait_for_split(out_dir, type, params, timeout=24 * 3600, poll_seconds=10):
+    """
+    Waits until the split is exported by another process (its manifest is written last)
+    :param str out_dir:
+    :param str type: one of [train,val,test]
+    :param dict params: from `export_params`
+    :param float timeout: seconds to wait at most
+    :param float poll_seconds:
+    """
+    print("-- TFRecords: waiting for %s export to %s" % (type, out_dir))
+    deadline = time.time() + timeout
+    while not is_exported(out_dir, type, params):
+        if time.time() > deadline:
+            raise Exception('TFRecords of %s weren\'t exported to %s in %d s!' % (type, out_dir, timeout))
+        time.sleep(poll_seconds)
+
+
+def export_split(datagen, type, target_size, out_dir, shards=16, with_flow=None):
+    """
+    Writes samples of the split into sharded TFRecords (without augmentation).
+    Every record has the image, label class indices (unknown pixels have index n_classes) of target size
+    and for flow generators also the previous frame and reverse optical flow.
+    Shards are written into a temporary directory and renamed into place, the manifest comes last,
+    so readers (see `wait_for_split`) never see a partial split.
+    :param BaseDataGenerator datagen: generator with loaded files
+    :param str type: one of [train,val,test]
+    :param tuple target_size: (height, width)
+    :param str out_dir:
+    :param int shards: number of files (samples are distributed round-robin)
+    :param bool with_flow: store previous frame and flow (default for flow generators)
+    """
+    from utils import print_progress
+
+    params = export_params(datagen, target_size, with_flow)
+    with_flow = params['with_flow']
+
+    # outdated export is invalid from now on
+    if os.path.exists(manifest_path(out_dir, type)):
+        os.remove(manifest_path(out_dir, type))
+
+    tmp_dir = os.path.join(out_dir, '.%s.tmp%d' % (type, os.getpid()))
+    if os.path.isdir(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+
+    data = datagen._data[type]
+    writers = [tf.python_io.TFRecordWriter(shard_path(tmp_dir, type, i, shards)) for i in range(shards)]
+
+    print("-- TFRecords: exporting %s (%d samples) to %s" % (type, len(data), out_dir))
+    try:
+        for i, (img, label_path) in enumerate(data):
+            frames = [img] if isinstance(img, str) else list(img)
+            new = datagen._load_resized(type, frames[-1], target_size)
+            label_img = datagen._load_img(label_path, datagen._label_imread_flags)
+
+            feature = {
+                'height': _int64_feature(target_size[0]),
+                'width': _int64_feature(target_size[1]),
+                'image': _bytes_feature(_png(new)),
+                'label': _bytes_feature(_png(datagen.label_encoder.encode(label_img, target_size))),
+            }
+
+            if with_flow:
+                old = datagen._load_resized(type, frames[-2], target_size)
+                flow = datagen._sample_flow(type, label_path, new, old, target_size)
+                feature['prev'] = _bytes_feature(_png(old))
+                feature['flow'] = _bytes_feature(np.ascontiguousarray(flow, dtype=np.float32).tobytes())
+
+            example = tf.train.Example(features=tf.train.Features(feature=feature))
+            writers[i % shards].write(example.SerializeToString())
+            print_progress(i + 1, len(data), prefix='%s:' % type, bar_length=50)
+    finally:
+        for writer in writers:
+            writer.close()
+
+    manifest = dict(params, samples=len(data), shards=shards)
+    with open(manifest_path(tmp_dir, type), 'w') as fp:
+        json.dump(manifest, fp)
+
+    for i in range(shards):
+        os.rename(shard_path(tmp_dir, type, i, shards), shard_path(out_dir, type, i, shards))
+    os.rename(manifest_path(tmp_dir, type), manifest_path(out_dir, type))
+    os.rmdir(tmp_dir)
+
+
+class TFRecordInput:
+    """
+    tf.data input pipeline over TFRecords written by `export_split`.
+
+    Reading, PNG decoding, normalization, flip augmentation, label scales and one-hot encoding run
+    in parallel map of TensorFlow's thread pool, batches are prefetched. Keras gets them from `generator`,
+    which only runs the prepared batch tensors in the session.
+    """
+
+    def __init__(self, datagen, records_dir, type, target_size, batch_size, training=False, shuffle_buffer=512, workers=8, prefetch=4):
+        """
+        :param BaseDataGenerator datagen: generator the records were exported with (label scales, normalization)
+        :param str records_dir: directory of exported records
+        :param str type: one of [train,val,test]
+        :param tuple target_size: (height, width) the records must be exported at
+        :param int batch_size:
+        :param bool training: shuffle and augment (random flip if enabled in datagen)
+        :param int shuffle_buffer: samples in shuffle buffer
+        :param int workers: parallel reads and maps
+        :param int prefetch: prefetched batches
+        """
+        self.manifest = read_manifest(records_dir, type)
+        if not is_exported(records_dir, type, export_params(datagen, target_size)):
+            raise Exception('TFRecords of %s in %s are missing or were exported with other parameters!' % (type, records_dir))
+
+        self.datagen = datagen
+        self.batch_size = batch_size
+        self.training = training
+        self.target_size = tuple(target_size)
+        self.with_flow = self.manifest['with_flow']
+        self.n_classes = self.manifest['n_classes']
+        self.subs = list(datagen.gt_sub)
+        self.sparse = datagen.sparse_labels
+        self.flip = training and datagen.is_augment and datagen.flip_enabled
+
+        normalizer = datagen.normalizer
+        self._mean = tf.constant(normalizer.mean, dtype=tf.float32)
+        self._std = tf.constant(normalizer.std, dtype=tf.float32)
+
+        files = [shard_path(records_dir, type, i, self.manifest['shards']) for i in range(self.manifest['shards'])]
+        record_shards = datagen.world_size > len(files)
+        if datagen.world_size > 1 and not record_shards:
+            # every rank reads only its own files
+            files = files[datagen.rank::datagen.world_size]
+        dataset = tf.data.TFRecordDataset(files, num_parallel_reads=workers)
+        if datagen.world_size > 1 and record_shards:
+            # less files than ranks, records are read by all of them and sharded
+            dataset = dataset.shard(datagen.world_size, datagen.rank)
+        if training:
+            dataset = dataset.shuffle(shuffle_buffer)
+        dataset = dataset.repeat()
+        dataset = dataset.map(self._parse, num_parallel_calls=workers)
+        dataset = dataset.batch(batch_size)
+        self.dataset = dataset.prefetch(prefetch)
+        self._next = None
+
+        print("-- TFRecordInput: %s %d samples from %s" % (type, self.manifest['samples'], records_dir))
+
+    def _decode_image(self, png):
+        # PNG holds RGB, generators work with BGR arrays as loaded by OpenCV
+        img = tf.reverse(tf.image.decode_png(png, channels=3), axis=[-1])
+        img = tf.reshape(img, self.target_size + (3,))
+        return tf.cast(img, tf.float32)
+
+    def _normalize(self, img):
+        if self.datagen.uint8_input:
+            # the model normalizes frames itself
+            return tf.cast(img, tf.uint8)
+
+        # the same as `Normalizer`: min-max to [0, 1], then mean and std
+        # (pixel values are integers, flat image becomes zeros)
+        min_val = tf.reduce_min(img)
+        max_val = tf.reduce_max(img)
+        img = (img - min_val) / tf.maximum(max_val - min_val, 1.)
+        return (img - self._mean) / self._std
+
+    def _label_target(self, label, sub):
+        size = tuple(a // sub for a in self.target_size)
+        if sub != 1:
+            label = tf.image.resize_nearest_neighbor(label[tf.newaxis], size)[0]
+        label = label[..., 0]
+
+        if self.sparse:
+            # unknown pixels keep the ignore index n_classes, masked out by the sparse loss
+            return tf.cast(label[..., tf.newaxis], tf.uint8)
+
+        return tf.one_hot(tf.cast(label, tf.int32), self.n_classes, dtype=tf.uint8)
+
+    def _parse(self, record):
+        features = {
+            'image': tf.FixedLenFeature([], tf.string),
+            'label': tf.FixedLenFeature([], tf.string),
+        }
+        if self.with_flow:
+            features['prev'] = tf.FixedLenFeature([], tf.string)
+            features['flow'] = tf.FixedLenFeature([], tf.string)
+        parsed = tf.parse_single_example(record, features)
+
+        img = self._decode_image(parsed['image'])
+        label = tf.reshape(tf.image.decode_png(parsed['label'], channels=1), self.target_size + (1,))
+
+        if self.with_flow:
+            prev = self._decode_image(parsed['prev'])
+            flow = tf.reshape(tf.decode_raw(parsed['flow'], tf.float32), self.target_size + (2,))
+
+        if self.flip:
+            flip = tf.random_uniform([]) < 0.5
+            img = tf.cond(flip, lambda: tf.reverse(img, axis=[1]), lambda: img)
+            label = tf.cond(flip, lambda: tf.reverse(label, axis=[1]), lambda: label)
+            if self.with_flow:
+                prev = tf.cond(flip, lambda: tf.reverse(prev, axis=[1]), lambda: prev)
+                # mirrored flow points the other way horizontally
+                flow = tf.cond(flip, lambda: tf.reverse(flow, axis=[1]) * [-1., 1.], lambda: flow)
+
+        if self.with_flow:
+            inputs = (self._normalize(prev), self._normalize(img), flow)
+        else:
+            inputs = (self._normalize(img),)
+
+        outputs = tuple(self._label_target(label, sub) for sub in self.subs)
+        return inputs, outputs
+
+    def generator(self, session=None):
+        """
+        Endless generator of batches for Keras `fit_generator`
+        :param tf.Session session: session of the model (Keras session by default)
+        """
+        if session is None:
+            from keras import backend as K
+            session = K.get_session()
+
+        if self._next is None:
+            self._next = self.dataset.make_one_shot_iterator().get_next()
+
+        while True:
+            inputs, outputs = session.run(self._next)
+            yield list(inputs), list(outputs)
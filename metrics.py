@@ -54,18 +54,28 @@ def mean_iou(y_true, y_pred, smooth=None, axis=-1):
     What is a good evaluation measure for semantic segmentation?.
     IEEE Trans. Pattern Anal. Mach. Intell.. 26. . 10.5244/C.27.32.
     https://en.wikipedia.org/wiki/Jaccard_index
+
+    Targets may be one-hot or sparse class indices (with last dimension 1). Unknown pixels (all-zero one-hot
+    or the sparse ignore index n_classes) don't count into the mean.
     """
     if smooth is None:
         smooth = K.epsilon()
     pred_shape = K.shape(y_pred)
     true_shape = K.shape(y_true)
 
+    # sparse targets (class indices) are expanded to one-hot, the ignore index gives an all-zero row
+    y_true = K.switch(
+        K.equal(true_shape[-1], 1),
+        lambda: K.one_hot(K.cast(y_true[..., 0], 'int32'), num_classes=pred_shape[-1]),
+        lambda: y_true
+    )
+
     # reshape such that w and h dim are multiplied together
     y_pred_reshaped = K.reshape(y_pred, (-1, pred_shape[-1]))
-    y_true_reshaped = K.reshape(y_true, (-1, true_shape[-1]))
+    y_true_reshaped = K.reshape(y_true, (-1, pred_shape[-1]))
 
     # correctly classified
-    clf_pred = K.one_hot(K.argmax(y_pred_reshaped), num_classes=true_shape[-1])
+    clf_pred = K.one_hot(K.argmax(y_pred_reshaped), num_classes=pred_shape[-1])
     equal_entries = K.cast(K.equal(clf_pred, y_true_reshaped), dtype='float32') * y_true_reshaped
 
     intersection = K.sum(equal_entries, axis=1)
@@ -74,4 +84,18 @@ def mean_iou(y_true, y_pred, smooth=None, axis=-1):
     # smooth added to avoid dividing by zero
     iou = (intersection + smooth) / ((union_per_class - intersection) + smooth)
 
-    return K.mean(iou)
+    valid = K.cast(K.greater(K.sum(y_true_reshaped, axis=1), 0), 'float32')
+    return K.sum(iou * valid) / K.maximum(K.sum(valid), 1.)
+
+
+def sparse_crossentropy_ignore(y_true, y_pred):
+    """
+    Sparse categorical crossentropy, pixels with the ignore index n_classes (unknown) give zero loss
+    like all-zero one-hot targets in categorical crossentropy.
+    """
+    n_classes = K.int_shape(y_pred)[-1]
+    y_true = K.cast(y_true, 'int32')
+    valid = K.less(y_true, n_classes)
+    y_true = y_true * K.cast(valid, 'int32')
+    loss = K.sparse_categorical_crossentropy(y_true, y_pred)
+    return loss * K.cast(valid[..., 0], K.floatx())
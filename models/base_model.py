@@ -2,6 +2,9 @@ from abc import ABCMeta, abstractmethod
 
 import keras.utils
 from keras import optimizers
+from keras.layers import Input
+
+from layers import InputNormalization, Warp
 
 
 class BaseModel:
@@ -42,6 +45,60 @@ class BaseModel:
         """
         pass
 
+    def resized(self, target_size):
+        """
+        The same model built for other input size (e.g. crops for training, full frames for evaluation),
+        weights don't depend on the size, so they can be copied between both
+        :param tuple target_size: (height, width)
+        :rtype: BaseModel
+        """
+        model = type(self)(target_size, self.n_classes, debug_samples=self.debug_samples)
+        model.sparse_labels = self.sparse_labels
+        model.lr_params = self.lr_params
+        if self.input_normalization is not None:
+            model.use_uint8_input(*self.input_normalization)
+        return model
+
+    # (mean, std) of the dataset if the model takes uint8 frames and normalizes them itself
+    input_normalization = None
+
+    def use_uint8_input(self, mean, std):
+        """
+        Rebuilds the model to take uint8 frames, which are normalized by its first layer
+        (weights are kept compatible, the normalization has none)
+        :param tuple mean: per-channel mean (of the [0, 1] image)
+        :param tuple std: per-channel std
+        """
+        self.input_normalization = (tuple(mean), tuple(std))
+        self._model = self._create_model()
+
+    def _image_input(self, shape, name=None):
+        """
+        Input of a frame for `_create_model`
+        :param tuple shape: (height, width, channels)
+        :param str name:
+        :return tuple: input layer and normalized frame for the network (the same tensor for float input)
+        """
+        if self.input_normalization is None:
+            inp = Input(shape=shape, name=name)
+            return inp, inp
+
+        inp = Input(shape=shape, name=name, dtype='uint8')
+        norm_name = name + '_norm' if name is not None else None
+        return inp, InputNormalization(*self.input_normalization, name=norm_name)(inp)
+
+    def flow_scale(self):
+        """
+        Fraction of target size the optical flow input needs, warping layers get flow resized to their resolution
+        (must be called before `make_multi_gpu`)
+        :return float: scale of the finest warped layer (1.0 without warping)
+        """
+        flow_sizes = [layer.input_shape[1][1:3] for layer in self._model.layers if isinstance(layer, Warp)]
+        if not flow_sizes:
+            return 1.
+
+        return max(max(float(h) / self.target_size[0], float(w) / self.target_size[1]) for h, w in flow_sizes)
+
     def make_multi_gpu(self, n_gpu):
         from keras.utils import multi_gpu_model
         self._model = multi_gpu_model(self._model, n_gpu)
@@ -152,7 +209,9 @@ class BaseModel:
         """dictionary of custom objects (as per keras definition)"""
         import metrics
         return {
-            'mean_iou': metrics.mean_iou
+            'mean_iou': metrics.mean_iou,
+            'sparse_crossentropy_ignore': metrics.sparse_crossentropy_ignore,
+            'InputNormalization': InputNormalization,
         }
 
     lr_params = None
@@ -185,6 +244,15 @@ class BaseModel:
     def loss_weights(self):
         return None
 
+    # targets are class indices (height, width, 1) instead of one-hot tensors
+    sparse_labels = False
+
+    def loss(self):
+        if self.sparse_labels:
+            import metrics
+            return metrics.sparse_crossentropy_ignore
+        return keras.losses.categorical_crossentropy
+
     def compile(self, lr=None, lr_decay=0.):
         if lr is not None:
             self.lr_params = {'lr': lr, 'decay': lr_decay}
@@ -192,9 +260,10 @@ class BaseModel:
         print("-- Optimizer: " + type(self.optimizer()).__name__)
         print("---- Params: ", self._optimizer_params())
         print("---- For Training: ", self.training_phase)
+        print("---- Sparse labels: ", self.sparse_labels)
 
         self._model.compile(
-            loss=keras.losses.categorical_crossentropy,
+            loss=self.loss(),
             optimizer=self.optimizer(),
             metrics=self.metrics(),
             loss_weights=self.loss_weights()
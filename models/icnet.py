@@ -251,8 +251,7 @@ class ICNet(BaseModel):
             return [out]
 
     def _create_model(self):
-        inp = Input(shape=self.target_size + (3,))
-        x = inp
+        inp, x = self._image_input(self.target_size + (3,))
 
         # (1/2)
         branch_half = self.branch_half(self.input_shape)
@@ -11,13 +11,13 @@ class ICNetWarp(ICNet):
     warp_decoder = []
 
     def _create_model(self):
-        img_old = Input(shape=self.input_shape, name='data_old')
-        img_new = Input(shape=self.input_shape, name='data_new')
+        data_old, img_old = self._image_input(self.input_shape, name='data_old')
+        data_new, img_new = self._image_input(self.input_shape, name='data_new')
         flo = Input(shape=self.target_size + (2,), name='data_flow')
 
-        all_inputs = [img_old, img_new, flo]
+        all_inputs = [data_old, data_new, flo]
 
-        transformed_flow = flow_cnn(self.target_size)(all_inputs)
+        transformed_flow = flow_cnn(self.target_size)([img_old, img_new, flo])
 
         x = img_new
         x_old = img_old
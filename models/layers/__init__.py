@@ -1,2 +1,3 @@
 from warp import *
 from bilinear_upsampling import BilinearUpSampling2D
+from input_normalization import InputNormalization
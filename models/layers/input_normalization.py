@@ -0,0 +1,30 @@
+import keras.backend as K
+from keras.engine import Layer
+
+
+class InputNormalization(Layer):
+    """
+    Normalizes uint8 frames in the graph, the same as `generator.preprocessing.Normalizer`:
+    min-max of every image to [0, 1] (flat image becomes zeros), then per-channel mean and std.
+    Has no weights, so weights of models fed with normalized float frames fit.
+    """
+
+    def __init__(self, mean=(0., 0., 0.), std=(1., 1., 1.), **kwargs):
+        self.mean = [float(v) for v in mean]
+        self.std = [float(v) for v in std]
+        super(InputNormalization, self).__init__(**kwargs)
+
+    def call(self, inputs, **kwargs):
+        x = K.cast(inputs, 'float32')
+        min_val = K.min(x, axis=[1, 2, 3], keepdims=True)
+        max_val = K.max(x, axis=[1, 2, 3], keepdims=True)
+        x = (x - min_val) / K.maximum(max_val - min_val, 1.)
+        return (x - K.constant(self.mean)) / K.constant(self.std)
+
+    def compute_output_shape(self, input_shape):
+        return input_shape
+
+    def get_config(self):
+        config = {'mean': self.mean, 'std': self.std}
+        base_config = super(InputNormalization, self).get_config()
+        return dict(list(base_config.items()) + list(config.items()))
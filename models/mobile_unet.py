@@ -157,9 +157,9 @@ class MobileUNet(BaseModel):
         return Activation(mobilenet.relu6, name='%sconv_pw_%d_relu' % (prefix, block_id))(x)
 
     def _create_model(self):
-        input = Input(shape=(self.target_size[0], self.target_size[1], 3))
+        input, x = self._image_input((self.target_size[0], self.target_size[1], 3))
 
-        b00 = self._conv_block(input, 32, self.alpha, strides=(2, 2), block_id=0)
+        b00 = self._conv_block(x, 32, self.alpha, strides=(2, 2), block_id=0)
         b01 = self._depthwise_conv_block(b00, 64, self.alpha, self.depth_multiplier, block_id=1)
 
         b02 = self._depthwise_conv_block(b01, 128, self.alpha, self.depth_multiplier, block_id=2, strides=(2, 2))
@@ -106,12 +106,12 @@ class MobileUNetWarp(MobileUNet):
         return b18
 
     def _create_model(self):
-        img_old = Input(shape=self.target_size + (3,), name='data_old')
-        img_new = Input(shape=self.target_size + (3,), name='data_new')
+        data_old, img_old = self._image_input(self.target_size + (3,), name='data_old')
+        data_new, img_new = self._image_input(self.target_size + (3,), name='data_new')
         flo = Input(shape=self.target_size + (2,), name='data_flow')
 
-        all_inputs = [img_old, img_new, flo]
-        transformed_flow = flow_cnn(self.target_size)(all_inputs)
+        all_inputs = [data_old, data_new, flo]
+        transformed_flow = flow_cnn(self.target_size)([img_old, img_new, flo])
 
         # -------- OLD FRAME BRANCH
         self.old_b00, self.old_b01, self.old_b03, self.old_b05, self.old_b11, self.old_b13 = self.frame_branch(img_old, prefix='old_')
@@ -9,12 +9,12 @@ class SegNetWarp(SegNet):
     warp_decoder = []
 
     def _create_model(self):
-        img_old = Input(self.input_shape, name='data_old')
-        img_new = Input(self.input_shape, name='data_new')
+        data_old, img_old = self._image_input(self.input_shape, name='data_old')
+        data_new, img_new = self._image_input(self.input_shape, name='data_new')
         flo = Input(shape=self.target_size + (2,), name='data_flow')
 
-        all_inputs = [img_old, img_new, flo]
-        transformed_flow = flow_cnn(self.target_size)(all_inputs)
+        all_inputs = [data_old, data_new, flo]
+        transformed_flow = flow_cnn(self.target_size)([img_old, img_new, flo])
 
         # encoder
         block_0 = self.block_model(self.input_shape, 64, 1, True)
@@ -0,0 +1,225 @@
+import argparse
+import hashlib
+import json
+import os
+from multiprocessing import Pool
+
+import config
+from generator import CamVidFlowGenerator, CityscapesFlowGenerator
+from utils import print_progress
+
+
+def create_generator(dataset, dataset_path, prev_skip, optical_flow_type):
+    if dataset == 'cityscapes':
+        return CityscapesFlowGenerator(dataset_path, prev_skip=prev_skip, optical_flow_type=optical_flow_type)
+    elif dataset == 'camvid':
+        return CamVidFlowGenerator(dataset_path, optical_flow_type=optical_flow_type)
+    else:
+        raise Exception('Unknown dataset %s!' % dataset)
+
+
+def frame_pairs(datagen, types):
+    """
+    :param BaseFlowGenerator datagen: generator with loaded files
+    :param list types: splits
+    :return list: sorted unique (type, old path, new path) the generator computes flow of
+    """
+    pairs = set()
+    for type in types:
+        for (old_path, new_path), _ in datagen._data[type]:
+            pairs.add((type, old_path, new_path))
+    return sorted(pairs)
+
+
+# generator of the worker process (optical flow objects can't be shared between processes)
+_datagen = None
+
+
+def _init_worker(dataset, dataset_path, prev_skip, optical_flow_type, flow_scale, cache_dir):
+    global _datagen
+    _datagen = create_generator(dataset, dataset_path, prev_skip, optical_flow_type)
+    _datagen.flow_scale = flow_scale
+    # workers only write, so the cache is unlimited there and never listed, the parent trims it to the budget
+    _datagen.use_flow_cache(cache_dir)
+
+
+def _compute(task):
+    type, old_path, new_path, sizes = task
+    misses = _datagen.flow_cache.misses
+    for size in sizes:
+        old = _datagen._load_resized(type, old_path, size)
+        new = _datagen._load_resized(type, new_path, size)
+        # reverse flow, the same as generators compute (cached flows are only read)
+        _datagen.calc_optical_flow(new, old)
+    return old_path, new_path, _datagen.flow_cache.misses > misses
+
+
+def load_sizes(type, target_size, crop_scale):
+    """
+    :return list: sizes frames of the split are loaded at in training (see `BaseDataGenerator._load_size`)
+    """
+    sizes = [tuple(target_size)]
+    if type == 'train' and crop_scale is not None and crop_scale != 1:
+        sizes.append(tuple(int(round(a * crop_scale)) for a in target_size))
+    return sizes
+
+
+def precompute(datagen, args, target_size, types, shard, shards, crop_scale=None):
+    """
+    Computes flows of this shard of frame pairs into the flow cache.
+    Done pairs are logged next to the cache, so the interrupted shard resumes without loading them again.
+    """
+    pairs = frame_pairs(datagen, types)[shard::shards]
+
+    run_key = json.dumps({
+        'dataset': args.dataset,
+        'types': types,
+        'target_size': list(target_size),
+        'crop_scale': crop_scale,
+        'prev_skip': int(args.prev_skip),
+        'flow': datagen.flow_params,
+        'flow_scale': datagen.flow_scale,
+    }, sort_keys=True)
+    log_dir = os.path.join(args.cache, 'precompute')
+    if not os.path.isdir(log_dir):
+        os.makedirs(log_dir)
+    log_path = os.path.join(log_dir, '%s_%dof%d.txt' % (hashlib.md5(run_key.encode('utf-8')).hexdigest()[:10], shard, shards))
+
+    done = set()
+    if os.path.exists(log_path):
+        with open(log_path, 'r') as fp:
+            done = set(tuple(line.rstrip('\n').split('\t')) for line in fp)
+
+    # every pair is computed at all sizes training loads it at, before it is logged as done
+    tasks = [
+        (type, old_path, new_path, tuple(load_sizes(type, target_size, crop_scale)))
+        for type, old_path, new_path in pairs if (old_path, new_path) not in done
+    ]
+    print("-- shard %d/%d: %d pairs, %d already done" % (shard, shards, len(pairs), len(pairs) - len(tasks)))
+    if not tasks:
+        return
+
+    computed = 0
+    pool = Pool(args.workers, _init_worker, (args.dataset, args.data_path, int(args.prev_skip), args.flow, datagen.flow_scale, args.cache))
+    try:
+        with open(log_path, 'a') as fp:
+            for i, (old_path, new_path, was_computed) in enumerate(pool.imap_unordered(_compute, tasks, chunksize=4)):
+                fp.write('%s\t%s\n' % (old_path, new_path))
+                fp.flush()
+                computed += was_computed
+                print_progress(i + 1, len(tasks), prefix='flows:', bar_length=50)
+    finally:
+        pool.terminate()
+        pool.join()
+
+    print("-- shard %d/%d: computed flows of %d pairs, %d were cached" % (shard, shards, computed, len(tasks) - computed))
+
+    if args.flow_cache_mb > 0:
+        # the same budget as training keeps, so training doesn't evict the cache right away
+        from generator.flow_cache import FlowCache
+        cache = FlowCache(args.cache, args.flow_cache_mb * 2 ** 20)
+        cache.trim()
+        print("-- " + str(cache))
+
+
+if __name__ == '__main__':
+    def parse_arguments():
+        parser = argparse.ArgumentParser(description='Precompute optical flow of dataset frame pairs into the flow cache')
+
+        parser.add_argument(
+            '--dataset',
+            help='Dataset [cityscapes, camvid]',
+            default='cityscapes'
+        )
+
+        parser.add_argument(
+            '--data_path',
+            help='Directory of datasets',
+            default=None
+        )
+
+        parser.add_argument(
+            '--types',
+            help='Splits separated by comma',
+            default='train,val'
+        )
+
+        parser.add_argument(
+            '--size',
+            help='Target size of frames (e.g. 256x512)',
+            default=None
+        )
+
+        parser.add_argument(
+            '--prev_skip',
+            help='Skip of the previous frame (Cityscapes)',
+            default=0
+        )
+
+        parser.add_argument(
+            '-f', '--flow',
+            help='Optical flow type [farn, dis, deepflow]',
+            default='farn'
+        )
+
+        parser.add_argument(
+            '--flow_scale',
+            help='Fraction of the target size flow is computed at (as --reduced_flow of training sets it)',
+            default=1.0
+        )
+
+        parser.add_argument(
+            '--cache',
+            help='Directory of the flow cache (default flow_cache in the dataset), pass the same one to train.py --flow_cache',
+            default=None
+        )
+
+        parser.add_argument(
+            '--flow_cache_mb',
+            help='Disk budget (MB) of the optical flow cache, the same default as train.py (0 = unlimited)',
+            default=20480
+        )
+
+        parser.add_argument(
+            '--crop_scale',
+            help='Also compute flows of training frames scaled for crops (train.py --crop_scale), '
+                 'otherwise only flows of target size are cached',
+            default=None
+        )
+
+        parser.add_argument(
+            '--shard',
+            help='Part of the pairs computed by this job as i/n (e.g. 0/4 on the first of four nodes)',
+            default='0/1'
+        )
+
+        parser.add_argument(
+            '-w', '--workers',
+            help='Number of processes computing flows',
+            default=None
+        )
+
+        args = parser.parse_args()
+        return args
+
+
+    args = parse_arguments()
+
+    shard, shards = (int(a) for a in args.shard.split('/'))
+    if not 0 <= shard < shards:
+        raise Exception('Shard %s is out of range!' % args.shard)
+
+    args.data_path = args.data_path or config.data_path()
+    args.workers = int(args.workers) if args.workers is not None else None
+    args.flow_cache_mb = int(args.flow_cache_mb)
+    target_size = tuple(int(a) for a in args.size.split('x')) if args.size is not None else config.target_size()
+    types = args.types.split(',')
+
+    datagen = create_generator(args.dataset, args.data_path, int(args.prev_skip), args.flow)
+    args.cache = args.cache or os.path.join(datagen.dataset_path, 'flow_cache')
+    if float(args.flow_scale) < 1:
+        datagen.set_flow_scale(float(args.flow_scale))
+    datagen.load_files(types)
+
+    precompute(datagen, args, target_size, types, shard, shards,
+               crop_scale=float(args.crop_scale) if args.crop_scale is not None else None)
@@ -99,9 +99,36 @@ if __name__ == '__main__':
             default=config.target_size()[1]
         )
 
+        parser.add_argument(
+            '--crop',
+            help='Train on random crops HEIGHTxWIDTH (validation on full frames), e.g. 256x256',
+            default=None
+        )
+
+        parser.add_argument(
+            '--crop_scale',
+            help='Crops are taken from frames of target size scaled by this factor',
+            default=1.0
+        )
+
+        parser.add_argument(
+            '--uint8',
+            action='store_true',
+            help='Frames are shipped as uint8 and normalized by the model',
+            default=False
+        )
+
+        parser.add_argument(
+            '--reduced_flow',
+            action='store_true',
+            help='Compute optical flow at resolution of the finest warped layer of the model',
+            default=False
+        )
+
         parser.add_argument(
             '--aug',
-            help='Data Augmentation',
+            action='store_true',
+            help='Data Augmentation (random rotation and zoom of training samples)',
             default=False
         )
 
@@ -110,18 +137,99 @@ if __name__ == '__main__':
             help='Workers',
             default=1
         )
+
+        parser.add_argument(
+            '--sample_threads',
+            help='Threads building samples of a batch concurrently (each with its own optical flow instance)',
+            default=0
+        )
         parser.add_argument(
             '--multiprocess',
             help='Multiprocess',
             default=False
         )
 
+        parser.add_argument(
+            '--process_workers',
+            help='Processes building batches into shared memory (0 = build in keras workers)',
+            default=0
+        )
+
+        parser.add_argument(
+            '--store',
+            help='Directory of preprocessed memory-mapped samples (built when missing or outdated)',
+            default=None
+        )
+
+        parser.add_argument(
+            '--cache_mb',
+            help='Memory budget (MB) of the decoded images cache',
+            default=0
+        )
+
+        parser.add_argument(
+            '--flow_cache',
+            help='Directory of the optical flow cache (shared by runs with the same flow type), precompute_flow.py fills <dataset>/flow_cache by default',
+            default=None
+        )
+
+        parser.add_argument(
+            '--flow_cache_mb',
+            help='Disk budget (MB) of the optical flow cache (0 = unlimited)',
+            default=20480
+        )
+
         parser.add_argument(
             '--queue',
             help='Max queue',
             default=50
         )
 
+        parser.add_argument(
+            '--sparse',
+            action='store_true',
+            help='Sparse labels (class indices instead of one-hot)',
+            default=False
+        )
+
+        parser.add_argument(
+            '--reuse_buffers',
+            action='store_true',
+            help='Write batches into a rotating pool of preallocated arrays',
+            default=False
+        )
+
+        parser.add_argument(
+            '--clips',
+            action='store_true',
+            help='Build samples clip by clip, frames shared by samples of a sequence are decoded once',
+            default=False
+        )
+
+        parser.add_argument(
+            '--tfrecords',
+            help='Directory of TFRecords (exported by rank 0 when missing), input goes through tf.data pipeline (not with --crop)',
+            default=None
+        )
+
+        parser.add_argument(
+            '--importance_floor',
+            help='Draw training samples by their loss, this share of drawing stays uniform (e.g. 0.3)',
+            default=None
+        )
+
+        parser.add_argument(
+            '--rank',
+            help='Index of this training process (data shard)',
+            default=0
+        )
+
+        parser.add_argument(
+            '--world_size',
+            help='Number of training processes sharing the dataset',
+            default=1
+        )
+
         parser.add_argument(
             '--gpu_percent',
             help='How much GPU memory will be taken',
@@ -156,8 +264,9 @@ if __name__ == '__main__':
     print("---------------")
     print("data augmentation", args.aug)
     print("---------------")
-    print("workers", args.workers, "multiprocess", multiprocess)
+    print("workers", args.workers, "multiprocess", multiprocess, "process workers", args.process_workers)
     print("max_queue", args.queue)
+    print("sparse labels", args.sparse)
     print("---------------")
 
     if args.gid is not None:
@@ -173,12 +282,17 @@ if __name__ == '__main__':
     from keras.backend.tensorflow_backend import set_session
     import tensorflow as tf
 
+    session_config = None
     if args.gpu_percent is not None:
         print("--Using %f gpu" % float(args.gpu_percent))
         config = tf.ConfigProto()
         config.gpu_options.per_process_gpu_memory_fraction = float(args.gpu_percent)
         config.gpu_options.allow_growth = True
-        set_session(tf.Session(config=config))
+        if int(args.process_workers) > 0:
+            # batch producer processes must be forked before the session exists, trainer creates it after them
+            session_config = config
+        else:
+            set_session(tf.Session(config=config))
 
     try:
         epochs = int(args.epochs)
@@ -197,7 +311,7 @@ if __name__ == '__main__':
         print("target size", target_size)
         print("---------------")
 
-        data_augmentation = bool(args.aug)
+        data_augmentation = args.aug
 
         trainer = Trainer(
             model_name=args.model,
@@ -208,7 +322,12 @@ if __name__ == '__main__':
             debug_samples=debug_samples,
             early_stopping=early_stopping,
             optical_flow_type=optical_flow_type,
-            data_augmentation=data_augmentation
+            data_augmentation=data_augmentation,
+            sparse_labels=args.sparse,
+            crop_size=tuple(int(a) for a in args.crop.split('x')) if args.crop is not None else None,
+            crop_scale=float(args.crop_scale),
+            uint8_input=args.uint8,
+            reduced_flow=args.reduced_flow
         )
 
         trainer.model.compile(
@@ -226,7 +345,20 @@ if __name__ == '__main__':
             restart_training=restart_training,
             workers=int(args.workers),
             max_queue=int(args.queue),
-            multiprocess=multiprocess
+            multiprocess=multiprocess,
+            process_workers=int(args.process_workers),
+            store_path=args.store,
+            cache_mb=int(args.cache_mb),
+            reuse_buffers=args.reuse_buffers,
+            rank=int(args.rank),
+            world_size=int(args.world_size),
+            clips=args.clips,
+            tfrecords_path=args.tfrecords,
+            importance_floor=float(args.importance_floor) if args.importance_floor is not None else None,
+            flow_cache_path=args.flow_cache,
+            flow_cache_mb=int(args.flow_cache_mb),
+            sample_threads=int(args.sample_threads),
+            session_config=session_config
         )
     except KeyboardInterrupt:
         print("Keyboard interrupted")
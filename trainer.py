@@ -3,12 +3,13 @@ import numpy as np
 np.random.seed(2018)
 
 import json
+import os
 
 from keras.callbacks import ModelCheckpoint, LambdaCallback
 
 import config
 import utils
-from callbacks import SaveLastTrainedEpochCallback, CustomTensorBoard
+from callbacks import SaveLastTrainedEpochCallback, CustomTensorBoard, FullFrameValidation, SampleLossFeedback
 from generator import *
 from models import *
 import importlib
@@ -19,7 +20,8 @@ import re
 class Trainer:
     train_callbacks = []
 
-    def __init__(self, model_name, dataset_path, target_size, batch_size, n_gpu, debug_samples=0, early_stopping=10, optical_flow_type='farn', data_augmentation=True):
+    def __init__(self, model_name, dataset_path, target_size, batch_size, n_gpu, debug_samples=0, early_stopping=10, optical_flow_type='farn', data_augmentation=False,
+                 sparse_labels=False, crop_size=None, crop_scale=1.0, uint8_input=False, reduced_flow=False):
         is_debug = debug_samples > 0
 
         self.debug_samples = debug_samples
@@ -29,6 +31,7 @@ class Trainer:
         self.target_size = target_size
         self._early_stopping = early_stopping
         self._optical_flow_type = optical_flow_type
+        self.sparse_labels = sparse_labels
         print("-- Number of GPUs used %d" % self.n_gpu)
         print("-- Batch size (on all GPUs) %d" % self.batch_size)
 
@@ -37,10 +40,11 @@ class Trainer:
         # -------------  pick the right model with proper generator
         # -------------------------------------------------------- SEGNET
         if model_name == 'segnet':
-            self.datagen = CityscapesGenerator(dataset_path, debug_samples=debug_samples)
+            self.datagen = CityscapesGenerator(dataset_path, debug_samples=debug_samples, sparse_labels=sparse_labels)
             model = SegNet(target_size, self.datagen.n_classes, debug_samples=debug_samples)
         elif 'segnet_warp' in model_name:
-            self.datagen = CityscapesFlowGenerator(dataset_path, debug_samples=debug_samples, prev_skip=prev_skip, flip_enabled=not is_debug, optical_flow_type=optical_flow_type)
+            self.datagen = CityscapesFlowGenerator(dataset_path, debug_samples=debug_samples, prev_skip=prev_skip, flip_enabled=not is_debug, optical_flow_type=optical_flow_type,
+                                                   sparse_labels=sparse_labels)
 
             if model_name == 'segnet_warp0':
                 model = SegnetWarp0(target_size, self.datagen.n_classes, debug_samples=debug_samples)
@@ -64,10 +68,11 @@ class Trainer:
                 model = SegnetWarp0123(target_size, self.datagen.n_classes, debug_samples=debug_samples)
         # -------------------------------------------------------- ICNET
         elif model_name == 'icnet':
-            self.datagen = CityscapesGeneratorForICNet(dataset_path, debug_samples=debug_samples)
+            self.datagen = CityscapesGeneratorForICNet(dataset_path, debug_samples=debug_samples, sparse_labels=sparse_labels)
             model = ICNet(target_size, self.datagen.n_classes, debug_samples=debug_samples)
         elif 'icnet_warp' in model_name:
-            self.datagen = CityscapesFlowGeneratorForICNet(dataset_path, debug_samples=debug_samples, prev_skip=prev_skip, flip_enabled=not is_debug, optical_flow_type=optical_flow_type)
+            self.datagen = CityscapesFlowGeneratorForICNet(dataset_path, debug_samples=debug_samples, prev_skip=prev_skip, flip_enabled=not is_debug, optical_flow_type=optical_flow_type,
+                                                           sparse_labels=sparse_labels)
 
             if model_name == 'icnet_warp0':
                 model = ICNetWarp0(target_size, self.datagen.n_classes, debug_samples=debug_samples)
@@ -87,6 +92,27 @@ class Trainer:
 
         print("-- Selected model", model.name)
 
+        if data_augmentation:
+            # flip and brightness are set up by the generator, rotation and zoom are opt-in
+            self.datagen.set_geometric_augmentation()
+        model.sparse_labels = sparse_labels
+
+        if uint8_input:
+            # frames are shipped as uint8, the model normalizes them with the mean and std of the dataset
+            self.datagen.uint8_input = True
+            model.use_uint8_input(self.datagen.normalizer.mean, self.datagen.normalizer.std)
+
+        if reduced_flow and isinstance(self.datagen, BaseFlowGenerator):
+            # flow is computed only at the resolution of the finest warped layer
+            self.datagen.set_flow_scale(model.flow_scale())
+
+        # -------------  train on crops, validate on full frames (weights are copied to full size model)
+        self.eval_model = None
+        if crop_size is not None:
+            self.eval_model = model
+            model = model.resized(crop_size)
+            self.datagen.set_crop(crop_size, crop_scale)
+
         # -------------  set multi gpu model
         self.model = model
         self.cpu_model = None
@@ -174,7 +200,7 @@ class Trainer:
         """
         :param run_name:
         :param is_restart_set:
-        :return:
+        :return: restart epoch, run name and batch size, weights to load (None to start from scratch)
         """
 
         # add save epoch to json callback
@@ -190,14 +216,12 @@ class Trainer:
         restart_epoch = 0
         restart_run_name = None
         batch_size = None
+        weights_file = None
 
         if is_restart_set:
             restart_epoch, restart_run_name, weights_file, batch_size = self.get_last_epoch()
 
-            if weights_file is not None:
-                self.model.load_model(weights_file)
-
-        return restart_epoch, restart_run_name, batch_size
+        return restart_epoch, restart_run_name, batch_size, weights_file
 
     def prepare_callbacks(self, run_name, epochs, use_validation_data=False):
         # ------------- tensorboard
@@ -239,13 +263,23 @@ class Trainer:
         # lr_power = 0.9
         # self.train_callbacks.append(lr_scheduler(epochs, lr_base, lr_power))
 
-    def fit_model(self, run_name, epochs, restart_training=False, workers=1, max_queue=20, multiprocess=False):
+    def _print_cache_stats(self, epoch, logs):
+        print("-- " + str(self.datagen.image_cache))
+
+    def _print_flow_cache_stats(self, epoch, logs):
+        print("-- " + str(self.datagen.flow_cache))
+
+    def fit_model(self, run_name, epochs, restart_training=False, workers=1, max_queue=20, multiprocess=False, process_workers=0,
+                  store_path=None, cache_mb=0, reuse_buffers=False, rank=0, world_size=1,
+                  clips=False, tfrecords_path=None, importance_floor=None, flow_cache_path=None, flow_cache_mb=20480,
+                  sample_threads=0, session_config=None):
         if not self.is_debug:
-            restart_epoch, restart_run_name, batch_size = self.prepare_restarting(restart_training, run_name)
+            restart_epoch, restart_run_name, batch_size, weights_file = self.prepare_restarting(restart_training, run_name)
         else:
             restart_epoch = 0
             restart_run_name = None
             batch_size = None
+            weights_file = None
 
         if restart_run_name is not None:
             run_name = restart_run_name
@@ -257,16 +291,94 @@ class Trainer:
 
         self.datagen.load_files()
 
-        train_generator = self.datagen.flow('train', batch_size, self.target_size)
+        if world_size > 1:
+            # every training process takes its own disjoint part of the data
+            self.datagen.shard(rank, world_size)
+
+        if store_path is not None:
+            # preprocessed samples (with optical flow for warp models)
+            self.datagen.use_store(store_path, self.target_size, with_flow=isinstance(self.datagen, BaseFlowGenerator))
+
+        if cache_mb > 0:
+            self.datagen.use_cache(cache_mb * 2 ** 20)
+            self.train_callbacks.append(LambdaCallback(on_epoch_end=self._print_cache_stats))
+
+        if flow_cache_path is not None and isinstance(self.datagen, BaseFlowGenerator):
+            # flows computed once are shared by later epochs and runs
+            self.datagen.use_flow_cache(flow_cache_path, flow_cache_mb * 2 ** 20 if flow_cache_mb > 0 else None)
+
+        if getattr(self.datagen, 'flow_cache', None) is not None:
+            self.train_callbacks.append(LambdaCallback(on_epoch_end=self._print_flow_cache_stats))
+
+        if importance_floor is not None:
+            # losses of batches are attributed to their samples, which needs batches in order of `flow`
+            if tfrecords_path is not None or process_workers > 0 or multiprocess or workers > 1 or clips:
+                raise Exception('Importance sampling works only with single worker flow!')
+
+            sampler = self.datagen.use_importance_sampling('train', importance_floor)
+            self.train_callbacks.append(SampleLossFeedback(sampler))
+
+        # process batch producers are closed after training
+        producers = []
+        if tfrecords_path is not None:
+            # input processing runs in tf.data thread pool, keras just runs the batch tensors
+            if self.datagen.crop_size is not None:
+                raise Exception('TFRecords hold full frames, training on crops isn\'t supported with them!')
+
+            from generator.tfrecords import TFRecordInput, export_params, export_split, is_exported, wait_for_split
+            params = export_params(self.datagen, self.target_size)
+            for type in ['train', 'val']:
+                if is_exported(tfrecords_path, type, params):
+                    continue
+                # all ranks share the records (and shard them when reading), only the first one (re)exports them
+                if rank == 0:
+                    export_split(self.datagen, type, self.target_size, tfrecords_path)
+                else:
+                    wait_for_split(tfrecords_path, type, params)
+
+            train_generator = TFRecordInput(self.datagen, tfrecords_path, 'train', self.target_size, batch_size,
+                                            training=not self.is_debug).generator()
+            val_generator = TFRecordInput(self.datagen, tfrecords_path, 'val', self.target_size, batch_size).generator()
+            workers = 1
+            multiprocess = False
+        elif process_workers > 0:
+            # batches are built by process pool into shared memory, keras just takes them from it
+            print("-- Building batches in %d processes" % process_workers)
+            train_generator = self.datagen.flow_parallel('train', batch_size, self.target_size, process_workers, hold=max_queue + 1,
+                                                         shuffle=not self.is_debug)
+            val_generator = self.datagen.flow_parallel('val', batch_size, self.target_size, process_workers, hold=max_queue + 1)
+            producers = [train_generator, val_generator]
+            workers = 1
+            multiprocess = False
+        elif multiprocess or workers > 1:
+            # every worker builds batches by index, so they are not duplicated
+            train_generator = self.datagen.sequence('train', batch_size, self.target_size, shuffle=not self.is_debug)
+            val_generator = self.datagen.sequence('val', batch_size, self.target_size, shuffle=False)
+        elif clips:
+            # frames and flows shared by samples of a sequence are computed once
+            pool_size = max_queue + 2 if reuse_buffers else 0
+            train_generator = self.datagen.flow_clips('train', batch_size, self.target_size, shuffle=not self.is_debug, pool_size=pool_size)
+            val_generator = self.datagen.flow_clips('val', batch_size, self.target_size, pool_size=pool_size)
+        else:
+            # queued batches + the one being trained on + the one being built
+            pool_size = max_queue + 2 if reuse_buffers else 0
+            # samples of a batch (with their optical flows) may be built concurrently
+            train_generator = self.datagen.flow('train', batch_size, self.target_size, pool_size=pool_size, shuffle=not self.is_debug,
+                                                threads=sample_threads)
+            val_generator = self.datagen.flow('val', batch_size, self.target_size, pool_size=pool_size, threads=sample_threads)
+
+        # TF session is created only after batch producer processes are forked from this one
+        if session_config is not None:
+            import tensorflow as tf
+            from keras.backend.tensorflow_backend import set_session
+            set_session(tf.Session(config=session_config))
+
+        if weights_file is not None:
+            self.model.load_model(weights_file)
+
         train_steps = self.datagen.steps_per_epoch('train', batch_size)
-        val_generator = self.datagen.flow('val', batch_size, self.target_size)
         val_steps = self.datagen.steps_per_epoch('val', batch_size)
 
-        if not self.is_debug:
-            # -- shuffle dataset after every epoch
-            shuffler = LambdaCallback(on_epoch_end=lambda epoch, logs: self.datagen.shuffle('train'))
-            self.train_callbacks.append(shuffler)
-
         # ------------- losswise dashboard
 
         losswise_params = {
@@ -293,20 +405,31 @@ class Trainer:
 
         self.prepare_callbacks(run_name, epochs)
 
-        self.model.k.fit_generator(
-            generator=train_generator,
-            steps_per_epoch=train_steps,
-            epochs=epochs,
-            initial_epoch=restart_epoch,
-            verbose=1,
-            validation_data=val_generator,
-            validation_steps=val_steps,
-            callbacks=self.train_callbacks,
-            max_queue_size=max_queue,
-            shuffle=not self.is_debug,
-            use_multiprocessing=multiprocess,
-            workers=workers
-        )
+        if self.eval_model is not None:
+            # keras would validate the crop size model, full frames go through the full size model instead
+            self.eval_model.compile()
+            full_frame_validation = FullFrameValidation(self.cpu_model or self.model.k, self.eval_model.k, val_generator, val_steps)
+            self.train_callbacks.insert(0, full_frame_validation)
+            val_generator = None
+
+        try:
+            self.model.k.fit_generator(
+                generator=train_generator,
+                steps_per_epoch=train_steps,
+                epochs=epochs,
+                initial_epoch=restart_epoch,
+                verbose=1,
+                validation_data=val_generator,
+                validation_steps=val_steps,
+                callbacks=self.train_callbacks,
+                max_queue_size=max_queue,
+                shuffle=not self.is_debug,
+                use_multiprocessing=multiprocess,
+                workers=workers
+            )
+        finally:
+            for producer in producers:
+                producer.close()
 
         # save final model
         self.model.save_final(self.get_run_path(run_name, '../../weights/'), epochs)
@@ -65,7 +65,35 @@ class VideoEvaluator:
 
     _last_frame = None
     _last_prediction = None
+    # flow of consecutive frames (keeps the last gray frame and flow of the video)
+    _flow_stream = None
+    # optical flow of warp models at resolution of their finest warped layer
+    reduced_flow = False
     _models = []
+    _buffers = None
+
+    def _input_buffer(self, name, shape, dtype):
+        """
+        Preallocated input (batch of one) which is reused for every frame
+        :param str name:
+        :param tuple shape: shape of one sample
+        :param dtype:
+        :return:
+        """
+        if self._buffers is None:
+            self._buffers = {}
+
+        buffer = self._buffers.get(name)
+        if buffer is None or buffer.shape[1:] != shape or buffer.dtype != dtype:
+            buffer = np.empty((1,) + shape, dtype=dtype)
+            self._buffers[name] = buffer
+        return buffer
+
+    def _normalize_input(self, name, frame):
+        size = config.target_size()
+        buffer = self._input_buffer(name, size + (3,), datagen.frame_dtype)
+        datagen.normalize(frame, size, out=buffer[0])
+        return buffer
 
     def process_frame(self, frame, model, verbose=1):
         """
@@ -75,10 +103,8 @@ class VideoEvaluator:
         :return list: should be a list with the prediction (because of compatibility with warping prediciton)
         """
 
-        frame = cv2.resize(frame, config.target_size()[::-1])
-        frame_norm = datagen.normalize(frame, config.target_size())
-
-        input = [np.array([frame_norm])]
+        # resized and normalized in one pass (uint8 frames are normalized by the model)
+        input = [self._normalize_input('frame', frame)]
         return [model.k.predict(input, 1, verbose)]
 
     def process_frame_warping(self, frame, last_frame, model, last_prediction=None, verbose=1):
@@ -91,14 +117,15 @@ class VideoEvaluator:
         :return:
         """
 
-        flow = datagen.calc_optical_flow(frame, last_frame)
-        frame_norm = datagen.normalize(frame, config.target_size())
-        last_frame_norm = datagen.normalize(last_frame, config.target_size())
+        if self._flow_stream is not None:
+            flow = self._flow_stream.push(frame)
+        else:
+            flow = datagen.calc_optical_flow(frame, last_frame)
 
         input_with_flow = [
-            np.array([last_frame_norm]),
-            np.array([frame_norm]),
-            np.array([flow])
+            self._normalize_input('last_frame', last_frame),
+            self._normalize_input('frame', frame),
+            flow[np.newaxis]
         ]
 
         if last_prediction is not None:
@@ -121,6 +148,12 @@ class VideoEvaluator:
                 model.k.load_weights(model_params['weights'], by_name=True)
                 model.compile()
 
+                if model_params['warp']:
+                    datagen.set_flow_scale(model.flow_scale() if self.reduced_flow else 1.)
+                    self._flow_stream = datagen.flow_stream()
+                else:
+                    self._flow_stream = None
+
                 print('-- predicting model %s' % model.name)
 
                 # prepare output file for the model and input file
@@ -198,6 +231,20 @@ if __name__ == '__main__':
             default=None
         )
 
+        parser.add_argument(
+            '--reduced_flow',
+            action='store_true',
+            help='Optical flow is computed at resolution of the finest warped layer of each model',
+            default=False
+        )
+
+        parser.add_argument(
+            '--uint8',
+            action='store_true',
+            help='Frames are fed as uint8 and normalized by the models',
+            default=False
+        )
+
         args = parser.parse_args()
         return args
 
@@ -223,4 +270,10 @@ if __name__ == '__main__':
         'warp': True
     })
 
+    if args.uint8:
+        datagen.uint8_input = True
+        for model_params in videoEvaluator._models:
+            model_params['model'].use_uint8_input(datagen.normalizer.mean, datagen.normalizer.std)
+
+    videoEvaluator.reduced_flow = args.reduced_flow
     videoEvaluator.process_video(datagen, args.input)